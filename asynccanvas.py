@@ -0,0 +1,470 @@
+import asyncio
+import atexit
+import time
+import httpx
+
+import canvas
+from canvas import set_query_params, format_question_answers, sort_questions, \
+    is_throttled, backoff_delay, RateLimiter, RequestProfiler
+
+try:
+    import h2  # pylint: disable=unused-import
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+DEFAULT_CONCURRENCY = 100
+
+
+class AsyncCanvasSession:
+    """ Async counterpart of canvas.CanvasSession. Wraps a single httpx
+    client (using HTTP/2 multiplexing when the h2 package is installed and
+    the server supports it). The number of in-flight requests is capped by
+    the same adaptive rate limiter and retry policy as the sync client. """
+
+    def __init__(self, pool_size=canvas.DEFAULT_POOL_SIZE,
+                 timeout=canvas.DEFAULT_TIMEOUT,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 max_retries=canvas.DEFAULT_MAX_RETRIES,
+                 profiler=None):
+        (connect, read) = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.profiler = profiler
+        self.client = httpx.AsyncClient(
+            http2=HTTP2, timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_connections=pool_size,
+                                max_keepalive_connections=pool_size))
+        self.limiter = RateLimiter(concurrency)
+        self.slot_available = asyncio.Condition()
+
+    async def acquire(self):
+        """ docstring """
+        async with self.slot_available:
+            await self.slot_available.wait_for(
+                lambda: self.limiter.in_flight < self.limiter.limit)
+            self.limiter.in_flight += 1
+        delay = self.limiter.delay()
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def release(self, headers=None, throttled=False):
+        """ docstring """
+        self.limiter.release(headers, throttled)
+        async with self.slot_available:
+            self.slot_available.notify_all()
+
+    async def request(self, method, url, **kwargs):
+        """ Sends a request, with the same pacing and retries as
+        canvas.CanvasSession.request """
+        idempotent = method.upper() in canvas.IDEMPOTENT_METHODS
+        start = time.monotonic()
+        cost = 0.0
+        attempt = 0
+        while True:
+            await self.acquire()
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                await self.release()
+                if not idempotent or attempt >= self.max_retries:
+                    self.profile(method, url, start, attempt, cost)
+                    raise
+                retry_after = None
+            else:
+                cost += float(response.headers.get('X-Request-Cost', 0))
+                throttled = is_throttled(response)
+                await self.release(response.headers, throttled)
+                if attempt >= self.max_retries or not (
+                        throttled or
+                        (idempotent and response.status_code in canvas.RETRY_STATUS_CODES)):
+                    self.profile(method, url, start, attempt, cost, response)
+                    return response
+                retry_after = response.headers.get('Retry-After')
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+            attempt += 1
+
+    def profile(self, method, url, start, retries, cost, response=None):
+        """ docstring """
+        if self.profiler is not None:
+            self.profiler.record(method, url, time.monotonic() - start,
+                                 retries, cost, response)
+
+    async def aclose(self):
+        """ docstring """
+        await self.client.aclose()
+
+
+class AsyncCanvas:
+    """ Async Canvas """
+
+    def __init__(self, token=None, args=None, session=None):
+        self.debug = args.debug if args else False
+        if args and args.canvas_token_file:
+            token = args.canvas_token_file.read().strip()
+            args.canvas_token_file.close()
+        elif args and args.canvas_token:
+            token = args.canvas_token
+        self.token = token
+        self.token_header = {'Authorization': f'Bearer {token}'}
+        if session is None:
+            session = AsyncCanvasSession(
+                pool_size=args.pool_size if args else canvas.DEFAULT_POOL_SIZE,
+                timeout=args.timeout if args and args.timeout else canvas.DEFAULT_TIMEOUT,
+                max_retries=args.max_retries if args else canvas.DEFAULT_MAX_RETRIES,
+                profiler=RequestProfiler() if args and args.profile else None)
+            if session.profiler is not None:
+                atexit.register(session.profiler.write_report, args.profile)
+        self.session = session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.aclose()
+
+    async def get_response(self, url):
+        """ docstring """
+        response = await self.session.request('GET', url, headers=self.token_header)
+        response.raise_for_status()
+        if self.debug:
+            print(response.text)
+        return response
+
+    async def iterate_pages(self, request):
+        """ Async iterator over the decoded pages of a paginated GET
+        request. Pages of the maximum size are requested, and, if the page
+        numbers are known, all remaining pages are requested at once. """
+        response = await self.get_response(
+            set_query_params(canvas.MAIN_URL + request, per_page=canvas.MAX_PER_PAGE))
+        yield response.json()
+        urls = canvas.Canvas.remaining_page_urls(response)
+        if urls is None:
+            while 'next' in response.links:
+                response = await self.get_response(response.links['next']['url'])
+                yield response.json()
+            return
+        tasks = [asyncio.ensure_future(self.get_response(url)) for url in urls]
+        try:
+            for task in tasks:
+                yield (await task).json()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def iterate(self, request, key=None):
+        """ Async iterator over the items of a paginated GET request. If
+        key is given, items are taken from that field of each page. """
+        async for page in self.iterate_pages(request):
+            for item in page[key] if key else page:
+                yield item
+
+    async def request(self, request, stop_at_first=False, paginate=False):
+        """ docstring """
+        if paginate and not stop_at_first:
+            return [page async for page in self.iterate_pages(request)]
+        response = await self.get_response(canvas.MAIN_URL + request)
+        retval = [response.json()]
+        while (not stop_at_first and
+               'current' in response.links and 'last' in response.links and
+               response.links['current']['url'] != response.links['last']['url']):
+            response = await self.get_response(response.links['next']['url'])
+            retval.append(response.json())
+        return retval
+
+    async def send(self, method, url, data=None):
+        """ docstring """
+        response = await self.session.request(method, canvas.MAIN_URL + url, json=data,
+                                              headers=self.token_header)
+        response.raise_for_status()
+        if response.status_code == 204:
+            return None
+        return response.json()
+
+    async def put(self, url, data):
+        """ docstring """
+        return await self.send('PUT', url, data)
+
+    async def post(self, url, data):
+        """ docstring """
+        return await self.send('POST', url, data)
+
+    async def delete(self, url):
+        """ docstring """
+        return await self.send('DELETE', url)
+
+    async def courses(self):
+        """ docstring """
+        async for course in self.iterate('/courses?include[]=term&state[]=available'):
+            yield course
+
+    async def course(self, course_id):
+        """ docstring """
+        for course in await self.request(f'/courses/{course_id}?include[]=term'):
+            return AsyncCourse(self, course)
+        return None
+
+    async def file(self, file_id):
+        """ docstring """
+        for file in await self.request(f'/files/{file_id}'):
+            return file
+        return None
+
+
+class AsyncCourse(AsyncCanvas):
+    """ Async Course """
+
+    def __init__(self, canvas_obj, course_data):
+        super().__init__(canvas_obj.token, session=canvas_obj.session)
+        self.data = course_data
+        self.id = course_data['id']
+        self.url_prefix = '/courses/%d' % self.id
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    async def page(self, url):
+        """ docstring """
+        for page in await self.request(f'{self.url_prefix}/pages/{url}'):
+            return AsyncPage(self, page)
+        return None
+
+    async def pages(self):
+        """ Async iterator over the pages of the course, including their
+        bodies """
+        # Listings omit the page body, so each page is fetched individually
+        urls = [page['url'] async for page in self.iterate(f'{self.url_prefix}/pages')]
+        for page in await asyncio.gather(*[self.page(url) for url in urls]):
+            if page is not None:
+                yield page
+
+    async def quizzes(self):
+        """ docstring """
+        async for quiz in self.iterate(f'{self.url_prefix}/quizzes'):
+            if quiz['quiz_type'] == 'assignment':
+                yield AsyncQuiz(self, quiz)
+
+    async def quiz(self, quiz_id):
+        """ docstring """
+        for quiz in await self.request(f'{self.url_prefix}/quizzes/{quiz_id}'):
+            return AsyncQuiz(self, quiz)
+        return None
+
+    async def assignments(self):
+        """ docstring """
+        async for assn in self.iterate(f'{self.url_prefix}/assignments'):
+            if 'online_quiz' not in assn['submission_types']:
+                yield AsyncAssignment(self, assn)
+
+    async def assignment(self, assignment_id):
+        """ docstring """
+        for assignment in await self.request(f'{self.url_prefix}/assignments/{assignment_id}'):
+            return AsyncAssignment(self, assignment)
+        return None
+
+    async def rubrics(self):
+        """ docstring """
+        async for rubric in self.iterate(f'{self.url_prefix}/rubrics?include[]=associations'):
+            yield rubric
+
+    async def students(self):
+        """ docstring """
+        async for student in self.iterate(f'{self.url_prefix}/users?enrollment_type=student'):
+            yield student
+
+
+class AsyncCourseSubObject(AsyncCanvas):
+
+    # If not provided, the request_param_name defaults to the lower-cased
+    # class name, without the 'Async' prefix.
+    def __init__(self, parent, route_name, data, id_field='id', request_param_name=None):
+        # MUST be available before calling self.get_course.
+        self.parent = parent
+        course = self.get_course()
+        super().__init__(course.token, session=course.session)
+
+        self.data = data
+        self.id_field = id_field
+        self.id = self.compute_id()
+        self.route_name = route_name
+        self.url_prefix = self.compute_url_prefix()
+        if not request_param_name:
+            request_param_name = type(self).__name__.lower()[len('async'):]
+        self.request_param_name = request_param_name
+
+    def get_course(self):
+        if isinstance(self.parent, AsyncCourse):
+            return self.parent
+        return self.parent.get_course()
+
+    def compute_id(self):
+        return self.data[self.id_field]
+
+    def compute_base_url(self):
+        return f'{self.parent.url_prefix}/{self.route_name}'
+
+    def compute_url_prefix(self):
+        return f'{self.compute_base_url()}/{self.id}'
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __setitem__(self, index, value):
+        self.data[index] = value
+
+    def items(self):
+        """ docstring """
+        return self.data.items()
+
+    async def update(self, data=None):
+        """ docstring """
+        if data:
+            self.data = data
+        if self.id:
+            self.data = await self.put(
+                self.url_prefix, {self.request_param_name: self.data})
+        else:
+            self.data = await self.post(self.compute_base_url(),
+                                        {self.route_name: self.data})
+        self.id = self.compute_id()
+        self.url_prefix = self.compute_url_prefix()
+        return self
+
+
+class AsyncQuiz(AsyncCourseSubObject):
+    """ Async Quiz """
+
+    def __init__(self, course, quiz_data):
+        super().__init__(course, "quizzes", quiz_data)
+
+    async def update_quiz(self, data=None):
+        """ docstring """
+        return await self.update(data)
+
+    async def question_group(self, group_id):
+        """ docstring """
+        if group_id is None:
+            return None
+        for group in await self.request(f'{self.url_prefix}/groups/{group_id}'):
+            return group
+        return None
+
+    # If group_id is None, creates a new one
+    async def update_question_group(self, group_id, group_data):
+        """ docstring """
+        if group_id:
+            return await self.put(f'{self.url_prefix}/groups/{group_id}',
+                                  {'quiz_groups': [group_data]})
+        return await self.post(f'{self.url_prefix}/groups', {'quiz_groups': [group_data]})
+
+    async def questions(self, qfilter=None):
+        """ docstring """
+        question_list = [question async for question in
+                         self.iterate(f'{self.url_prefix}/questions')]
+        group_ids = list(dict.fromkeys(q['quiz_group_id'] for q in question_list))
+        groups = dict(zip(group_ids, await asyncio.gather(
+            *[self.question_group(group_id) for group_id in group_ids])))
+        return sort_questions(question_list, groups, qfilter)
+
+    async def update_question(self, question_id, question):
+        """ docstring """
+        format_question_answers(question)
+        if question_id:
+            return await self.put(f'{self.url_prefix}/questions/{question_id}',
+                                  {'question': question})
+        return await self.post(f'{self.url_prefix}/questions', {'question': question})
+
+    async def delete_question(self, question_id):
+        """ docstring """
+        return await self.delete(f'{self.url_prefix}/questions/{question_id}')
+
+    async def reorder_questions(self, items):
+        """ docstring """
+        return await self.post(f'{self.url_prefix}/reorder', {'order': items})
+
+    async def submissions(self, include_user=True,
+                          include_submission=True, include_history=True,
+                          include_settings_only=False):
+        """ docstring """
+        submissions = {}
+        quiz_submissions = []
+        include = ''.join([
+            'include[]=user&' if include_user else '',
+            'include[]=submission&' if include_submission else '',
+            'include[]=submission_history&' if include_history else '',
+        ])
+        async for response in self.iterate_pages(f'{self.url_prefix}/submissions?{include}'):
+            quiz_submissions += [
+                qs for qs in response['quiz_submissions']
+                if include_settings_only or qs['workflow_state'] != 'settings_only'
+            ]
+            if include_submission:
+                for submission in response['submissions']:
+                    submissions[submission['id']] = submission
+        return (quiz_submissions, submissions)
+
+    async def submission_questions(self, quiz_submission):
+        """ docstring """
+        questions = {}
+        async for question in self.iterate(
+                f"/quiz_submissions/{quiz_submission['id']}/questions",
+                key='quiz_submission_questions'):
+            questions[question['id']] = question
+        return questions
+
+    async def send_quiz_grade(self, quiz_submission,
+                              question_id, points, comments=None):
+        """ docstring """
+        await self.put(f"{self.url_prefix}/submissions/{quiz_submission['id']}",
+                       {'quiz_submissions': [{
+                           'attempt': quiz_submission['attempt'],
+                           'questions': {question_id: {'score': points, 'comment': comments}}
+                       }]})
+
+
+class AsyncAssignment(AsyncCourseSubObject):
+    """ Async Assignment """
+
+    def __init__(self, course, assg_data):
+        super().__init__(course, "assignments", assg_data)
+
+    async def update_assignment(self, data=None):
+        """ docstring """
+        return await self.update(data)
+
+    async def rubric(self):
+        """ docstring """
+        for result in await self.request(
+                f"{self.get_course().url_prefix}/rubrics/"
+                f"{self.data['rubric_settings']['id']}?include[]=associations"):
+            return result
+        return None
+
+    async def update_rubric(self, rubric):
+        """ docstring """
+        rubric_data = {
+            'rubric': rubric,
+            'rubric_association': {
+                'association_id': self.id,
+                'association_type': 'Assignment',
+                'use_for_grading': True,
+                'purpose': 'grading',
+            },
+        }
+        await self.post(f'{self.get_course().url_prefix}/rubrics', rubric_data)
+
+    async def send_assig_grade(self, student, assessment):
+        """ docstring """
+        await self.put(f"{self.url_prefix}/submissions/{student['id']}",
+                       {'rubric_assessment': assessment})
+
+
+class AsyncPage(AsyncCourseSubObject):
+
+    def __init__(self, course, page_data):
+        super().__init__(course, "pages", page_data,
+                         id_field="url", request_param_name="wiki_page")
+
+    async def update_page(self, data=None):
+        """ docstring """
+        return await self.update(data)
@@ -1,8 +1,557 @@
 import argparse
-from collections import OrderedDict
+import atexit
+import copy
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import traceback
+import time
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import requests
+import requests.adapters
+import requests.structures
 
 MAIN_URL = 'https://canvas.ubc.ca/api/v1'
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (10, 120)  # (connect, read) in seconds
+MAX_PER_PAGE = 100
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_COURSE_JOBS = 4
+DEFAULT_ROSTER_MAX_AGE = 3600  # seconds
+GRADE_CHUNK_SIZE = 250  # students per bulk grade update
+PROGRESS_POLL_INTERVAL = 1.0  # initial delay (in seconds), doubled up to the cap
+PROGRESS_POLL_CAP = 30.0
+
+# Canvas throttling: each request is charged its cost plus a pre-flight
+# penalty while in flight, against a bucket that refills at a fixed rate.
+# See https://canvas.instructure.com/doc/api/file.throttling.html
+RATE_LIMIT_PREFLIGHT_COST = 50
+RATE_LIMIT_REFILL_RATE = 10.0  # units per second
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+DEFAULT_CACHE_SIZE = 200  # in MB
+# Time (in seconds) during which cached responses are used without
+# revalidation, by route. Other routes are always revalidated.
+CACHE_TTLS = {
+    '/courses': 3600,
+    '/courses/:id': 3600,
+}
+CACHED_HEADERS = ('Content-Type', 'Link', 'ETag', 'Last-Modified')
+CACHE_ACCESS_BATCH = 100  # access times written at once
+
+# Upper bounds (in seconds) of the buckets of the request latency histogram
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Subtracted from the time of incremental syncs, to allow for differences
+# between the local and the Canvas clocks
+SYNC_MARGIN = timedelta(minutes=5)
+
+
+def set_query_params(url, **params):
+    """ Returns the URL with the given query parameters added or replaced """
+    parts = urlsplit(url)
+    query = [(k, v) for (k, v) in parse_qsl(parts.query, keep_blank_values=True)
+             if k not in params]
+    query += [(k, str(v)) for (k, v) in params.items()]
+    return urlunsplit(parts._replace(query=urlencode(query, safe='[]')))
+
+
+def page_number(url):
+    """ Returns the numeric page parameter of a URL, or None for bookmark
+    (or missing) page parameters """
+    page = dict(parse_qsl(urlsplit(url).query)).get('page', '1')
+    return int(page) if page.isdigit() else None
+
+
+def route_template(url):
+    """ Returns the API route of a URL, without host, prefix, query and IDs
+    (e.g., '/courses/:id/quizzes/:id/submissions') """
+    path = urlsplit(url).path
+    prefix = urlsplit(MAIN_URL).path
+    if path.startswith(prefix):
+        path = path[len(prefix):]
+    return re.sub(r'/\d+(?=/|$)', '/:id', path)
+
+
+def sync_watermark():
+    """ Returns the time (in Canvas format) from which the next
+    incremental sync should start, if it starts now """
+    return (datetime.now(timezone.utc) - SYNC_MARGIN).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def remove_zip_duplicates(file_name):
+    """ Rewrites a ZIP file to which some names were written more than once
+    (e.g., when re-exporting into an existing file), keeping only the last
+    entry with each name """
+    with zipfile.ZipFile(file_name) as zipf:
+        entries = zipf.infolist()
+        latest = {entry.filename: entry for entry in entries}
+        if len(latest) == len(entries):
+            return
+        with zipfile.ZipFile(file_name + '.tmp', 'w') as new_zipf:
+            for entry in latest.values():
+                new_zipf.writestr(entry, zipf.read(entry))
+    os.replace(file_name + '.tmp', file_name)
+
+
+def prefetch(function, items, workers, window=None):
+    """ Generator of (item, function(item)) for each of the items, in
+    order. The calls run on up to workers threads, at most window (by default,
+    twice the number of workers) items ahead of the consumer. Items may be
+    any iterable, which is only consumed as needed. """
+    items = iter(items)
+    window = window or 2 * workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque((item, executor.submit(function, item))
+                        for item in islice(items, window))
+        try:
+            while pending:
+                (item, future) = pending.popleft()
+                result = future.result()
+                pending.extend((item, executor.submit(function, item))
+                               for item in islice(items, 1))
+                yield (item, result)
+        finally:
+            for (_, future) in pending:
+                future.cancel()
+
+
+def build_response(url, status_code, headers, body):
+    """ Builds a response object from stored data """
+    response = requests.Response()
+    response.status_code = status_code
+    response.url = url
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.encoding = 'utf-8'
+    response._content = body  # pylint: disable=protected-access
+    return response
+
+
+def is_throttled(response):
+    """ Returns whether a response was rejected by the Canvas rate limiter """
+    return response.status_code == 429 or (
+        response.status_code == 403 and 'Rate Limit Exceeded' in response.text)
+
+
+def backoff_delay(attempt, retry_after=None, base=1.0, cap=60.0):
+    """ Returns the delay (in seconds) before retry number attempt (from 0),
+    using exponential backoff with full jitter, unless the server provided
+    a Retry-After value """
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter:
+    """ Adaptive concurrency limiter driven by the X-Rate-Limit-Remaining
+    and X-Request-Cost headers returned by Canvas. The number of requests
+    allowed in flight shrinks as the bucket drains, and new requests are
+    delayed until the bucket is expected to have refilled enough. """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.remaining = None
+        self.updated_at = time.monotonic()
+        self.cost = 0.0
+        self.condition = threading.Condition()
+
+    def estimated_remaining(self):
+        """ docstring """
+        return self.remaining + RATE_LIMIT_REFILL_RATE * (time.monotonic() - self.updated_at)
+
+    def delay(self):
+        """ Returns how long (in seconds) a new request should wait """
+        with self.condition:
+            if self.remaining is None:
+                return 0
+            needed = (self.cost + RATE_LIMIT_PREFLIGHT_COST) * max(1, self.in_flight)
+            return max(0.0, (needed - self.estimated_remaining()) / RATE_LIMIT_REFILL_RATE)
+
+    def update(self, headers, throttled=False):
+        """ Updates the limiter with the headers of a response """
+        with self.condition:
+            remaining = headers.get('X-Rate-Limit-Remaining')
+            cost = headers.get('X-Request-Cost')
+            if cost is not None:
+                # Exponential moving average of the request cost
+                self.cost = 0.8 * self.cost + 0.2 * float(cost)
+            if throttled:
+                self.remaining = 0.0
+            elif remaining is not None:
+                self.remaining = float(remaining)
+            else:
+                return
+            self.updated_at = time.monotonic()
+            self.limit = max(1, min(self.max_concurrency, int(
+                self.remaining / (self.cost + RATE_LIMIT_PREFLIGHT_COST))))
+            self.condition.notify_all()
+
+    def acquire(self):
+        """ Blocks until a new request may be sent """
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+        delay = self.delay()
+        if delay:
+            time.sleep(delay)
+
+    def release(self, headers=None, throttled=False):
+        """ Signals the end of a request, with the headers of its response """
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+        if headers is not None:
+            self.update(headers, throttled)
+
+
+class ResponseCache:
+    """ Persistent cache of GET responses, stored in an SQLite database.
+    Entries are keyed by URL and token, and revalidated with their ETag
+    and Last-Modified values once their route's TTL expires. The least
+    recently used entries are evicted when the cache exceeds max_size
+    bytes. Access times are only written with the next store (or every
+    CACHE_ACCESS_BATCH lookups, and at exit), so that lookups do not
+    commit. """
+
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE * 2 ** 20, ttls=None):
+        self.max_size = max_size
+        self.ttls = CACHE_TTLS if ttls is None else ttls
+        self.lock = threading.Lock()
+        self.accessed = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                               key TEXT PRIMARY KEY, headers TEXT, body BLOB,
+                               size INTEGER, stored_at REAL, accessed_at REAL)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS responses_accessed
+                           ON responses (accessed_at)''')
+        self.db.commit()
+        (self.total_size,) = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def key(url, authorization):
+        """ docstring """
+        token_id = hashlib.sha256((authorization or '').encode()).hexdigest()[:16]
+        return f'{token_id} {url}'
+
+    def get(self, key):
+        """ Returns (headers, body, fresh) for a cached entry, or None """
+        with self.lock:
+            row = self.db.execute('SELECT headers, body, stored_at FROM responses WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is None:
+                return None
+            self.accessed[key] = time.time()
+            if len(self.accessed) >= CACHE_ACCESS_BATCH:
+                self.write_accesses()
+                self.db.commit()
+        (headers, body, stored_at) = row
+        ttl = self.ttls.get(route_template(key.split(' ', 1)[1]), 0)
+        return (json.loads(headers), body, time.time() - stored_at < ttl)
+
+    def store(self, key, response):
+        """ docstring """
+        headers = {h: response.headers[h] for h in CACHED_HEADERS if h in response.headers}
+        body = response.content
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.db.execute('''INSERT OR REPLACE INTO responses
+                               (key, headers, body, size, stored_at, accessed_at)
+                               VALUES (?, ?, ?, ?, ?, ?)''',
+                            (key, json.dumps(headers), body, len(body), now, now))
+            self.accessed.pop(key, None)
+            self.total_size += len(body) - (row[0] if row else 0)
+            self.write_accesses()
+            self.evict()
+            self.db.commit()
+
+    def refresh(self, key):
+        """ Marks a cached entry as just revalidated """
+        with self.lock:
+            self.db.execute('UPDATE responses SET stored_at = ? WHERE key = ?',
+                            (time.time(), key))
+            self.db.commit()
+
+    def write_accesses(self):
+        """ Writes the pending access times (without committing). Must be
+        called with the lock held. """
+        if self.accessed:
+            self.db.executemany('UPDATE responses SET accessed_at = ? WHERE key = ?',
+                                [(accessed_at, key) for (key, accessed_at)
+                                 in self.accessed.items()])
+            self.accessed = {}
+
+    def flush(self):
+        """ Writes the pending access times """
+        with self.lock:
+            self.write_accesses()
+            self.db.commit()
+
+    def evict(self):
+        """ Removes least recently used entries until the cache fits its
+        maximum size. Must be called with the lock held. """
+        if self.total_size <= self.max_size:
+            return
+        for (key, size) in self.db.execute(
+                'SELECT key, size FROM responses ORDER BY accessed_at').fetchall():
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.total_size -= size
+            if self.total_size <= self.max_size:
+                break
+
+
+class ResponseArchive:
+    """ Archive of all responses received in a run, used to replay the run
+    without network access. Bodies are compressed and appended to a data
+    file, and an index with their offsets is kept in a separate file, so
+    that replaying only reads the responses that are requested. Repeated
+    requests are replayed in the order they were recorded. """
+
+    def __init__(self, directory, replay=False):
+        self.replaying = replay
+        self.lock = threading.Lock()
+        self.data_path = os.path.join(directory, 'responses.dat')
+        index_path = os.path.join(directory, 'index.jsonl')
+        self.index = {}
+        if replay:
+            with open(index_path, 'r') as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self.index.setdefault(entry.pop('key'), []).append(entry)
+            self.data_file = open(self.data_path, 'rb')
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.data_file = open(self.data_path, 'wb')
+            self.index_file = open(index_path, 'w')
+
+    @staticmethod
+    def key(method, url, data=None):
+        """ docstring """
+        key = f'{method.upper()} {url}'
+        if data is not None:
+            key += ' ' + hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+        return key
+
+    def record(self, method, url, data, response):
+        """ docstring """
+        body = zlib.compress(response.content)
+        headers = {h: response.headers[h] for h in CACHED_HEADERS if h in response.headers}
+        with self.lock:
+            entry = {'key': self.key(method, url, data), 'offset': self.data_file.tell(),
+                     'length': len(body), 'status': response.status_code, 'headers': headers}
+            self.data_file.write(body)
+            self.data_file.flush()
+            self.index_file.write(json.dumps(entry) + '\n')
+            self.index_file.flush()
+
+    def replay(self, method, url, data=None):
+        """ Returns the next recorded response for a request """
+        with self.lock:
+            entries = self.index.get(self.key(method, url, data))
+            if not entries:
+                raise RuntimeError(f'No recorded response for {method} {url}')
+            entry = entries.pop(0) if len(entries) > 1 else entries[0]
+            self.data_file.seek(entry['offset'])
+            body = zlib.decompress(self.data_file.read(entry['length']))
+        return build_response(url, entry['status'], entry['headers'], body)
+
+
+class RequestProfiler:
+    """ Collects per-route statistics (calls, bytes received, latency
+    histogram, retries and rate limit cost) of the requests sent in a run """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    @staticmethod
+    def route(method, url):
+        """ Returns the route of a request, e.g.,
+        'GET /courses/:id/quizzes' """
+        if not url.startswith(MAIN_URL.rsplit('/v1', 1)[0] + '/'):
+            return f'{method.upper()} (file download)'
+        return f'{method.upper()} {route_template(url)}'
+
+    def stats(self, method, url):
+        """ Returns the statistics of a route. Must be called with the lock
+        held. """
+        return self.routes.setdefault(self.route(method, url), {
+            'calls': 0, 'cache_hits': 0, 'errors': 0, 'retries': 0, 'bytes': 0,
+            'cost': 0.0, 'time': 0.0, 'max_time': 0.0,
+            'latency': [0] * (len(LATENCY_BUCKETS) + 1),
+        })
+
+    def record(self, method, url, elapsed, retries, cost, response=None):
+        """ Records a request sent to Canvas (including all retries) """
+        bucket = sum(1 for limit in LATENCY_BUCKETS if elapsed > limit)
+        with self.lock:
+            stats = self.stats(method, url)
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['cost'] += cost
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['latency'][bucket] += 1
+            if response is None or response.status_code >= 400:
+                stats['errors'] += 1
+            if response is not None:
+                stats['bytes'] += len(response.content)
+
+    def record_cache_hit(self, method, url):
+        """ Records a request answered from the response cache """
+        with self.lock:
+            self.stats(method, url)['cache_hits'] += 1
+
+    def report(self):
+        """ Returns the statistics, with labelled latency histograms """
+        labels = [f'<={limit}s' for limit in LATENCY_BUCKETS] + [f'>{LATENCY_BUCKETS[-1]}s']
+        with self.lock:
+            return {route: dict(stats, latency=dict(zip(labels, stats['latency'])))
+                    for (route, stats) in self.routes.items()}
+
+    def write_report(self, path):
+        """ Saves the report as JSON and prints a summary table, with the
+        slowest routes first """
+        report = self.report()
+        with open(path, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'\n{"Route":60} {"Calls":>6} {"Cached":>6} {"Retry":>5} {"Errors":>6} '
+              f'{"MB":>7} {"Cost":>8} {"Time(s)":>8} {"Avg(s)":>6} {"Max(s)":>6}')
+        for (route, stats) in sorted(report.items(), key=lambda t: -t[1]['time']):
+            avg = stats['time'] / stats['calls'] if stats['calls'] else 0
+            print(f"{route[:60]:60} {stats['calls']:6} {stats['cache_hits']:6} "
+                  f"{stats['retries']:5} {stats['errors']:6} {stats['bytes'] / 2 ** 20:7.2f} "
+                  f"{stats['cost']:8.1f} {stats['time']:8.2f} {avg:6.2f} {stats['max_time']:6.2f}")
+        print(f'Request profile saved to {path}')
+
+
+class Roster:
+    """ Index of the students in a course, with lookups by Canvas ID, SIS
+    ID, login ID and email """
+
+    def __init__(self, students=None):
+        self.by_id = {}
+        self.by_sis_id = {}
+        self.by_login_id = {}
+        self.by_email = {}
+        for student in students or []:
+            self.add(student)
+
+    def indexes(self):
+        """ docstring """
+        return ((self.by_sis_id, 'sis_user_id'), (self.by_login_id, 'login_id'),
+                (self.by_email, 'email'))
+
+    def index(self, field):
+        """ Returns the dictionary of students by the given field """
+        if field == 'id':
+            return self.by_id
+        return next(index for (index, name) in self.indexes() if name == field)
+
+    def add(self, student):
+        """ Adds a student, replacing any student with the same Canvas ID """
+        self.remove(student['id'])
+        self.by_id[student['id']] = student
+        for (index, field) in self.indexes():
+            if student.get(field):
+                index[student[field]] = student
+
+    def remove(self, student_id):
+        """ docstring """
+        student = self.by_id.pop(student_id, None)
+        if student is None:
+            return
+        for (index, field) in self.indexes():
+            if student.get(field) and index.get(student[field]) is student:
+                del index[student[field]]
+
+    def find(self, key, fields=('sis_user_id', 'login_id', 'email')):
+        """ Returns the student whose value for one of the given fields
+        (tried in this order) is key, or None if not found. Canvas IDs are
+        only looked up if 'id' is one of the fields. """
+        for field in fields:
+            if field == 'id' and isinstance(key, str) and key.isdigit():
+                student = self.by_id.get(int(key))
+            else:
+                student = self.index(field).get(key)
+            if student is not None:
+                return student
+        return None
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+def format_question_answers(question):
+    """ Reformat question data to account for different format between
+    input and output in Canvas API """
+    if 'answers' not in question:
+        return
+    for answer in question['answers']:
+        if 'html' in answer:
+            answer['answer_html'] = answer['html']
+        if question['question_type'] == 'matching_question':
+            if 'left' in answer:
+                answer['answer_match_left'] = answer['left']
+            if 'right' in answer:
+                answer['answer_match_right'] = answer['right']
+        if question['question_type'] == 'multiple_dropdowns_question':
+            if 'weight' in answer:
+                answer['answer_weight'] = answer['weight']
+            if 'text' in answer:
+                answer['answer_text'] = answer['text']
+
+
+def sort_questions(question_list, groups, qfilter=None):
+    """ Assigns positions (and group points) to quiz questions, returning
+    the questions and groups as dictionaries sorted by position """
+    groups = {k: v for k, v in groups.items() if k is not None}
+    # Ungrouped questions are numbered in order, skipping the positions
+    # taken by groups. As both are in ascending order, a single pass over
+    # the sorted group positions is enough.
+    group_positions = sorted(group['position'] for group in groups.values() if group)
+    next_group = 0
+    questions = {}
+    i = 1
+    for question in question_list:
+        group = groups.get(question['quiz_group_id'])
+        if group:
+            question['points_possible'] = group['question_points']
+            question['position'] = group['position']
+        else:
+            while next_group < len(group_positions) and \
+                    group_positions[next_group] <= i + next_group:
+                next_group += 1
+            question['position'] = i + next_group
+            i += 1
+        if not qfilter or qfilter(question['id']):
+            questions[question['id']] = question
+    return (OrderedDict(sorted(questions.items(), key=lambda t: t[1]['position'])),
+            OrderedDict(sorted(groups.items(), key=lambda t: t[1]['position'])))
 
 
 class ExtendAction(argparse.Action):
@@ -14,10 +563,144 @@ class ExtendAction(argparse.Action):
         setattr(namespace, self.dest, items)
 
 
+class BatchOutput:
+    """ Replacement for sys.stdout that collects what each batch worker
+    thread prints, so that the output of each course can be printed as a
+    single block. Other threads write directly to the original stream. """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            with self.lock:
+                return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def start(self):
+        """ Starts collecting the output of the current thread """
+        self.local.buffer = io.StringIO()
+
+    def finish(self, header):
+        """ Prints the output collected for the current thread """
+        text = self.local.buffer.getvalue()
+        self.local.buffer = None
+        with self.lock:
+            self.stream.write(f'{header}\n{text}\n')
+            self.stream.flush()
+
+
+class CanvasSession(requests.Session):
+    """ Keep-alive HTTP session shared by a Canvas client and every object
+    derived from it. Connections are pooled per host; the pool blocks
+    instead of opening extra connections, so it can be shared by worker
+    threads. """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, cache=None, archive=None,
+                 profiler=None, state_dir=None):
+        super().__init__()
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limiter = RateLimiter(pool_size)
+        self.cache = cache
+        self.archive = archive
+        self.profiler = profiler
+        self.state_dir = state_dir
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                                pool_maxsize=pool_size,
+                                                pool_block=True)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        """ Sends a request, or replays it from the response archive. When
+        recording, the response is added to the archive. """
+        if self.archive is not None and self.archive.replaying:
+            return self.archive.replay(method, url, kwargs.get('json'))
+        response = self.cached_request(method, url, **kwargs)
+        if self.archive is not None:
+            self.archive.record(method, url, kwargs.get('json'), response)
+        return response
+
+    def cached_request(self, method, url, **kwargs):
+        """ Sends a request, answering API GET requests from the response
+        cache when available (revalidating stale entries) """
+        if self.cache is None or method.upper() != 'GET' or not url.startswith(MAIN_URL):
+            return self.send_request(method, url, **kwargs)
+        headers = dict(kwargs.pop('headers', None) or {})
+        key = self.cache.key(url, headers.get('Authorization'))
+        entry = self.cache.get(key)
+        if entry is not None:
+            (cached_headers, body, fresh) = entry
+            if fresh:
+                if self.profiler is not None:
+                    self.profiler.record_cache_hit(method, url)
+                return build_response(url, 200, cached_headers, body)
+            if 'ETag' in cached_headers:
+                headers['If-None-Match'] = cached_headers['ETag']
+            if 'Last-Modified' in cached_headers:
+                headers['If-Modified-Since'] = cached_headers['Last-Modified']
+        response = self.send_request(method, url, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.refresh(key)
+            return build_response(url, 200, cached_headers, body)
+        if response.status_code == 200:
+            self.cache.store(key, response)
+        return response
+
+    def send_request(self, method, url, **kwargs):
+        """ Sends a request, pacing it with the rate limiter. Requests
+        rejected by the rate limiter are retried with backoff; idempotent
+        requests are also retried on server errors and connection
+        failures. """
+        kwargs.setdefault('timeout', self.timeout)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        start = time.monotonic()
+        cost = 0.0
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.limiter.release()
+                if not idempotent or attempt >= self.max_retries:
+                    self.profile(method, url, start, attempt, cost)
+                    raise
+                retry_after = None
+            else:
+                cost += float(response.headers.get('X-Request-Cost', 0))
+                throttled = is_throttled(response)
+                self.limiter.release(response.headers, throttled)
+                if attempt >= self.max_retries or not (
+                        throttled or
+                        (idempotent and response.status_code in RETRY_STATUS_CODES)):
+                    self.profile(method, url, start, attempt, cost, response)
+                    return response
+                retry_after = response.headers.get('Retry-After')
+            time.sleep(backoff_delay(attempt, retry_after))
+            attempt += 1
+
+    def profile(self, method, url, start, retries, cost, response=None):
+        """ docstring """
+        if self.profiler is not None:
+            self.profiler.record(method, url, time.monotonic() - start,
+                                 retries, cost, response)
+
+
 class Canvas:
     """ Canvas """
 
-    def __init__(self, token=None, args=None):
+    def __init__(self, token=None, args=None, session=None):
         self.debug = args.debug if args else False
         if args and args.canvas_token_file:
             token = args.canvas_token_file.read().strip()
@@ -26,10 +709,65 @@ class Canvas:
             token = args.canvas_token
         self.token = token
         self.token_header = {'Authorization': f'Bearer {token}'}
+        if session is None:
+            session = CanvasSession(
+                pool_size=args.pool_size if args else DEFAULT_POOL_SIZE,
+                timeout=args.timeout if args and args.timeout else DEFAULT_TIMEOUT,
+                max_retries=args.max_retries if args else DEFAULT_MAX_RETRIES,
+                cache=Canvas.open_cache(args),
+                archive=Canvas.open_archive(args),
+                profiler=RequestProfiler() if args and args.profile else None,
+                state_dir=args.cache if args else None)
+            if session.profiler is not None:
+                atexit.register(session.profiler.write_report, args.profile)
+        self.session = session
+        self.mirror = CourseMirror(args.mirror) if args and args.mirror else None
+
+    def load_state(self, name):
+        """ Returns the data saved with save_state in a previous run, or None
+        if not available (or if no cache directory is in use) """
+        if self.session.state_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.session.state_dir, f'{name}.json'), 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_state(self, name, data):
+        """ Saves data to be used by later runs, if a cache directory is in
+        use """
+        if self.session.state_dir is None:
+            return
+        path = os.path.join(self.session.state_dir, f'{name}.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(data, file)
+        os.replace(path + '.tmp', path)
 
     @staticmethod
-    def add_arguments(parser, course=True, quiz=False, assignment=False):
-        """ docstring """
+    def open_archive(args):
+        """ Returns the response archive selected by the command-line
+        arguments, if any """
+        if args and args.record:
+            return ResponseArchive(args.record)
+        if args and args.replay:
+            return ResponseArchive(args.replay, replay=True)
+        return None
+
+    @staticmethod
+    def open_cache(args):
+        """ Returns the response cache selected by the command-line
+        arguments, if any """
+        if not args or not args.cache:
+            return None
+        os.makedirs(args.cache, exist_ok=True)
+        return ResponseCache(os.path.join(args.cache, 'responses.sqlite'),
+                             max_size=args.cache_size * 2 ** 20)
+
+    @staticmethod
+    def add_arguments(parser, course=True, quiz=False, assignment=False, batch=False):
+        """ Adds the common command-line arguments. The batch mode
+        arguments are only added if batch is set (see batch_courses). """
         # Add argparse action='extend' for pre-3.8 python
         parser.register('action', 'extend', ExtendAction)
 
@@ -40,9 +778,44 @@ class Canvas:
                            help="File containing the Canvas token used for authentication")
         group.add_argument("-t", "--canvas-token",
                            help="Canvas token used for authentication")
+        parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE,
+                            help="Maximum number of open connections (and parallel requests) to Canvas")
+        parser.add_argument("--timeout", type=float,
+                            help="Timeout (in seconds) for Canvas requests")
+        parser.add_argument("--max-retries", type=int, default=DEFAULT_MAX_RETRIES,
+                            help="Maximum number of retries for failed or throttled requests")
+        parser.add_argument("--cache", metavar="DIR",
+                            help="Directory used to cache Canvas responses between runs")
+        parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, metavar="MB",
+                            help="Maximum size of the response cache")
+        parser.add_argument("--profile", nargs='?', const='profile.json', metavar="FILE",
+                            help="Save statistics of Canvas requests into a JSON file "
+                            "(default: profile.json) and print a summary at exit")
+        parser.add_argument("--mirror", metavar="DATABASE",
+                            help="Read course data from a local mirror created by mirror.py")
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument("--record", metavar="DIR",
+                           help="Save all Canvas responses into an archive for offline use")
+        group.add_argument("--replay", metavar="DIR",
+                           help="Use responses from an archive instead of connecting to Canvas")
         if course:
             parser.add_argument("-c", "--course", type=int,
                                 help="Course ID")
+            parser.add_argument("--roster-max-age", type=int, default=DEFAULT_ROSTER_MAX_AGE,
+                                metavar="SECONDS",
+                                help="Reuse the list of students saved in the --cache directory "
+                                "if it is more recent than this (0 to always download it)")
+        if course and batch:
+            group = parser.add_argument_group(
+                "batch mode", "Run the same operation on several courses at once")
+            group.add_argument("--courses", action='extend', nargs='+', type=int,
+                               metavar="COURSEID", help="Course IDs")
+            group.add_argument("--term",
+                               help="Use all available courses of the given term (by name)")
+            group.add_argument("--course-code", metavar="REGEX",
+                               help="Use all available courses whose code matches the regular expression")
+            group.add_argument("--course-jobs", type=int, default=DEFAULT_COURSE_JOBS, metavar="N",
+                               help="Number of courses processed at the same time")
         if quiz:
             parser.add_argument("-q", "--quiz", type=int,
                                 help="Quiz ID")
@@ -50,28 +823,80 @@ class Canvas:
             parser.add_argument("-a", "--assignment", type=int,
                                 help="Assignment ID")
 
-    def request(self, request, stop_at_first=False):
-        """ docstring """
-        retval = []
-        response = requests.get(MAIN_URL + request, headers=self.token_header)
-        while True:
-            response.raise_for_status()
-            if self.debug:
-                print(response.text)
+    def request(self, request, stop_at_first=False, paginate=False):
+        """ Returns the list of decoded pages for a GET request. If paginate
+        is set, pages are retrieved as described in iterate_pages. """
+        if paginate and not stop_at_first:
+            return list(self.iterate_pages(request))
+        response = self.get_response(MAIN_URL + request)
+        retval = [response.json()]
+        while (not stop_at_first and
+               'current' in response.links and 'last' in response.links and
+               response.links['current']['url'] != response.links['last']['url']):
+            response = self.get_response(response.links['next']['url'])
             retval.append(response.json())
-            if (stop_at_first or
-                    'current' not in response.links or
-                    'last' not in response.links or
-                    response.links['current']['url'] == response.links['last']['url']):
-                break
-            response = requests.get(
-                response.links['next']['url'], headers=self.token_header)
         return retval
 
+    def iterate_pages(self, request):
+        """ Generator of the decoded pages of a paginated GET request, in
+        order. Pages of the maximum size are requested, and, if the page
+        numbers are exposed by the 'last' link of the first response, the
+        following pages are fetched concurrently (up to the session pool
+        size) ahead of the consumer. """
+        response = self.get_response(
+            set_query_params(MAIN_URL + request, per_page=MAX_PER_PAGE))
+        urls = self.remaining_page_urls(response)
+        yield response.json()
+        if urls is None:
+            while 'next' in response.links:
+                response = self.get_response(response.links['next']['url'])
+                yield response.json()
+            return
+        del response
+        for (_, page) in prefetch(self.get_json, urls, self.session.pool_size,
+                                  self.session.pool_size):
+            yield page
+
+    def iterate(self, request, key=None):
+        """ Generator of the items of a paginated GET request, yielded as
+        each page arrives. If key is given, items are taken from that field
+        of each page. """
+        for page in self.iterate_pages(request):
+            yield from page[key] if key else page
+
+    def get_json(self, url):
+        """ docstring """
+        return self.get_response(url).json()
+
+    def get_response(self, url):
+        """ docstring """
+        response = self.session.get(url, headers=self.token_header)
+        response.raise_for_status()
+        if self.debug:
+            print(response.text)
+        return response
+
+    @staticmethod
+    def remaining_page_urls(response):
+        """ Returns the URLs of all pages following the given response, or
+        None if they cannot be derived from its links """
+        if 'next' not in response.links:
+            return []
+        if 'last' not in response.links:
+            return None
+        last_url = response.links['last']['url']
+        last = page_number(last_url)
+        current = page_number(response.links['current']['url']) \
+            if 'current' in response.links else 1
+        if last is None or current is None:
+            return None
+        return [set_query_params(last_url, page=page)
+                for page in range(current + 1, last + 1)]
+
     def put(self, url, data):
         """ docstring """
-        response = requests.put(MAIN_URL + url, json=data,
-                                headers=self.token_header)
+        response = self.session.put(MAIN_URL + url, json=data,
+                                    headers=self.token_header)
         response.raise_for_status()
         if response.status_code == 204:
             return None
@@ -79,7 +904,7 @@ class Canvas:
 
     def post(self, url, data):
         """ docstring """
-        response = requests.post(
+        response = self.session.post(
             MAIN_URL + url, json=data, headers=self.token_header)
         response.raise_for_status()
         if response.status_code == 204:
@@ -88,21 +913,31 @@ class Canvas:
 
     def delete(self, url):
         """ docstring """
-        response = requests.delete(MAIN_URL + url, headers=self.token_header)
+        response = self.session.delete(MAIN_URL + url, headers=self.token_header)
         response.raise_for_status()
         if response.status_code == 204:
             return None
         return response.json()
 
+    def wait_progress(self, progress):
+        """ Polls a Canvas Progress object (as returned by asynchronous
+        operations), with increasing delays, until it is completed or has
+        failed. Returns its final state. """
+        attempt = 0
+        while progress['workflow_state'] in ('queued', 'running'):
+            time.sleep(min(PROGRESS_POLL_CAP, PROGRESS_POLL_INTERVAL * 2 ** attempt))
+            attempt += 1
+            progress = self.get_json(f"{MAIN_URL}/progress/{progress['id']}")
+        return progress
+
     def courses(self):
         """ docstring """
-        courses = []
-        for result in self.request('/courses?include[]=term&state[]=available'):
-            courses.extend(result)
-        return courses
+        return list(self.iterate('/courses?include[]=term&state[]=available'))
 
     def course(self, course_id, prompt_if_needed=False):
         """ docstring """
+        if course_id and self.mirror is not None:
+            return self.mirror.course(self, course_id)
         if course_id:
             for course in self.request(f'/courses/{course_id}?include[]=term'):
                 return Course(self, course)
@@ -114,9 +949,66 @@ class Canvas:
                 print(
                     f"{index:2}: {course['id']:7} - {term:10} / {course_code}")
             course_index = int(input('Which course? '))
+            if self.mirror is not None:
+                return self.mirror.course(self, courses[course_index]['id'])
             return Course(self, courses[course_index])
         return None
 
+    def batch_courses(self, args):
+        """ Returns the list of courses selected by the batch mode
+        arguments (--courses, --term and --course-code), or None if batch
+        mode was not requested. Courses given by ID are returned as IDs,
+        and only retrieved by run_batch, so that a wrong ID only fails
+        that course. """
+        if not (args.courses or args.term or args.course_code):
+            return None
+        if args.courses:
+            return list(args.courses)
+        code_re = re.compile(args.course_code or '')
+        return [self.course(course['id']) if self.mirror is not None else Course(self, course)
+                for course in self.courses()
+                if (not args.term or course.get('term', {}).get('name') == args.term) and
+                code_re.search(course.get('course_code', ''))]
+
+    def run_batch(self, courses, operation, jobs=DEFAULT_COURSE_JOBS):
+        """ Calls operation(course) for every course (or course ID, as
+        returned by batch_courses), on up to jobs courses at the same time.
+        The courses share the session (connection pool, rate limiter,
+        cache). An error in one course (including retrieving it) does not
+        stop the others; the output of each course is printed when it
+        ends, followed by a summary. Returns the list of courses (or
+        course IDs) that failed. """
+        output = BatchOutput(sys.stdout)
+
+        def run(course):
+            output.start()
+            (course_id, course_code) = (course, '(not retrieved)')
+            try:
+                if not isinstance(course, Course):
+                    course = self.course(course)
+                    if course is None:
+                        raise ValueError('course not found')
+                (course_id, course_code) = (course['id'], course['course_code'])
+                operation(course)
+                error = None
+            except Exception as exc:  # pylint: disable=broad-except
+                traceback.print_exc(file=output)
+                error = exc
+            output.finish(f'===== {course_id}: {course_code} =====')
+            return (course_id, course_code, error)
+
+        sys.stdout = output
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(run, courses))
+        finally:
+            sys.stdout = output.stream
+        print('Summary:')
+        for (course_id, course_code, error) in results:
+            result = f'FAILED ({type(error).__name__}: {error})' if error else 'OK'
+            print(f'{course_id:7} - {course_code}: {result}')
+        return [course for (course, (_, _, error)) in zip(courses, results) if error]
+
     def file(self, file_id):
         """ docstring """
         for file in self.request(f'/files/{file_id}'):
@@ -127,46 +1019,99 @@ class Course(Canvas):
     """ Course """
 
     def __init__(self, canvas, course_data):
-        super().__init__(canvas.token)
+        super().__init__(canvas.token, session=canvas.session)
         self.data = course_data
         self.id = course_data['id']
         self.url_prefix = '/courses/%d' % self.id
+        # Quizzes and assignments are loaded once and shared by all callers
+        self.quiz_cache = {}
+        self.assignment_cache = {}
+        self.quiz_list = None
+        self.assignment_list = None
+
+    def invalidate(self):
+        """ Discards the cached lists of quizzes and assignments (e.g.,
+        after one is created) """
+        self.quiz_list = None
+        self.assignment_list = None
 
     def __getitem__(self, index):
         return self.data[index]
 
+    def page(self, url):
+        """ docstring """
+        for page in self.request(f'{self.url_prefix}/pages/{url}'):
+            return Page(self, page)
+        return None
+
     def pages(self):
-        pages = []
-        for result in self.request(f'{self.url_prefix}/pages'):
-            # Per https://canvas.instructure.com/doc/api/pages.html#Page,
-            # the body is omitted from listing queries. So, we must query
-            # individually for each page.
-            for page_data in result:
-                new_page_datas = self.request(
-                    f'{self.url_prefix}/pages/{page_data["url"]}')
-                if len(new_page_datas) == 1:
-                    pages.append(Page(self, new_page_datas[0]))
-                elif len(new_page_datas) == 0:
-                    # Page not found
-                    return None
+        """ Returns all pages in the course, including their bodies. Pages
+        that cannot be retrieved are skipped. """
+        # Per https://canvas.instructure.com/doc/api/pages.html#Page,
+        # the body is omitted from listing queries. So, we must query
+        # individually for each page. Pages are queried concurrently, and,
+        # if a cache directory is in use, only if they have been updated
+        # since the last run.
+        state_name = f'pages_{self.id}'
+        cached = self.load_state(state_name) or {}
+        listing = list(self.iterate(f'{self.url_prefix}/pages'))
+        stale = [page_data['url'] for page_data in listing
+                 if page_data['url'] not in cached or
+                 cached[page_data['url']]['updated_at'] != page_data['updated_at']]
+        with ThreadPoolExecutor(max_workers=self.session.pool_size) as executor:
+            for (url, page) in zip(stale, executor.map(self.fetch_page, stale)):
+                if page is not None:
+                    cached[url] = page.data
                 else:
-                    # Too many pages found
-                    return None
+                    cached.pop(url, None)
+        pages = [Page(self, cached[page_data['url']]) for page_data in listing
+                 if page_data['url'] in cached]
+        self.save_state(state_name, {page['url']: page.data for page in pages})
         return pages
 
+    def fetch_page(self, url):
+        """ Returns a page, or None (with a warning) if it can't be retrieved """
+        try:
+            return self.page(url)
+        except requests.HTTPError as error:
+            print(f'WARNING: could not retrieve page {url}: {error}')
+            return None
+
     def quizzes(self):
-        """ docstring """
-        quizzes = []
-        for result in self.request(f'{self.url_prefix}/quizzes'):
-            quizzes += [Quiz(self, quiz)
-                        for quiz in result if quiz['quiz_type'] == 'assignment']
-        return quizzes
+        """ Returns the (graded) quizzes of the course, which are only
+        retrieved the first time """
+        if self.quiz_list is None:
+            self.quiz_list = [self.cached_quiz(quiz) for quiz in
+                              self.iterate(f'{self.url_prefix}/quizzes')
+                              if quiz['quiz_type'] == 'assignment']
+        return list(self.quiz_list)
+
+    def new_quiz(self, quiz_data):
+        """ Returns a new Quiz object for this course """
+        return Quiz(self, quiz_data)
+
+    def new_assignment(self, assignment_data):
+        """ Returns a new Assignment object for this course """
+        return Assignment(self, assignment_data)
+
+    def cached_quiz(self, quiz_data):
+        """ Returns the Quiz object for the given data, reusing (and
+        updating) the existing one if the quiz was already loaded """
+        quiz = self.quiz_cache.get(quiz_data['id'])
+        if quiz is None or quiz.id != quiz_data['id']:
+            quiz = self.quiz_cache[quiz_data['id']] = self.new_quiz(quiz_data)
+        else:
+            quiz.data = quiz_data
+        return quiz
 
     def quiz(self, quiz_id, prompt_if_needed=False):
         """ docstring """
         if quiz_id:
+            quiz = self.quiz_cache.get(quiz_id)
+            if quiz is not None and quiz.id == quiz_id:
+                return quiz
             for quiz in self.request(f'{self.url_prefix}/quizzes/{quiz_id}'):
-                return Quiz(self, quiz)
+                return self.cached_quiz(quiz)
         if prompt_if_needed:
             quizzes = self.quizzes()
             for index, quiz in enumerate(quizzes):
@@ -176,18 +1121,32 @@ class Course(Canvas):
         return None
 
     def assignments(self):
-        """ docstring """
-        assignments = []
-        for result in self.request(f'{self.url_prefix}/assignments'):
-            assignments += [Assignment(self, assn)
-                            for assn in result if 'online_quiz' not in assn['submission_types']]
-        return assignments
+        """ Returns the (non-quiz) assignments of the course, which are
+        only retrieved the first time """
+        if self.assignment_list is None:
+            self.assignment_list = [self.cached_assignment(assn) for assn in
+                                    self.iterate(f'{self.url_prefix}/assignments')
+                                    if 'online_quiz' not in assn['submission_types']]
+        return list(self.assignment_list)
+
+    def cached_assignment(self, assignment_data):
+        """ Same as cached_quiz, for assignments """
+        assignment = self.assignment_cache.get(assignment_data['id'])
+        if assignment is None or assignment.id != assignment_data['id']:
+            assignment = self.assignment_cache[assignment_data['id']] = \
+                self.new_assignment(assignment_data)
+        else:
+            assignment.data = assignment_data
+        return assignment
 
     def assignment(self, assignment_id, prompt_if_needed=False):
         """ docstring """
         if assignment_id:
+            assignment = self.assignment_cache.get(assignment_id)
+            if assignment is not None and assignment.id == assignment_id:
+                return assignment
             for assignment in self.request(f'{self.url_prefix}/assignments/{assignment_id}'):
-                return Assignment(self, assignment)
+                return self.cached_assignment(assignment)
         if prompt_if_needed:
             assignments = self.assignments()
             for index, assignment in enumerate(assignments):
@@ -199,19 +1158,78 @@ class Course(Canvas):
 
     def rubrics(self):
         """ docstring """
-        full = []
-        for result in self.request(f'{self.url_prefix}/rubrics?include[]=associations'):
-            full += result
-        return full
+        return list(self.iterate(f'{self.url_prefix}/rubrics?include[]=associations'))
 
     def students(self):
-        """ docstring """
-        students = {}
-        for result in self.request(f'{self.url_prefix}/users?enrollment_type=student'):
-            for student in result:
-                sis_user_id = student['sis_user_id'] if student['sis_user_id'] else '0'
-                students[sis_user_id] = student
-        return students
+        """ Returns a dictionary of students by SIS ID """
+        return dict(self.roster().by_sis_id)
+
+    def roster(self, max_age=0):
+        """ Returns the index of students in the course. If a cache
+        directory is in use, the roster is saved between runs, and used as
+        is if it was downloaded less than max_age seconds ago; otherwise,
+        the whole roster is downloaded again. """
+        state_name = f'roster_{self.id}'
+        state = self.load_state(state_name)
+        if state and time.time() - state['refreshed_at'] <= max_age:
+            return Roster(state['students'])
+        refreshed_at = time.time()
+        roster = Roster(self.iterate(f'{self.url_prefix}/users?enrollment_type[]=student'
+                                     '&include[]=email'))
+        self.save_state(state_name, {'refreshed_at': refreshed_at, 'students': list(roster)})
+        return roster
+
+    def iterate_submissions_since(self, assignment_id, since=None,
+                                  include_user=True, include_history=True):
+        """ Generator of the submissions of an assignment that were
+        submitted or graded since the given time (all of them, if since is
+        None). A submission that was both submitted and graded since then
+        may be yielded twice. """
+        include = ''.join([
+            '&include[]=user' if include_user else '',
+            '&include[]=submission_history' if include_history else '',
+        ])
+        url = (f'{self.url_prefix}/students/submissions?student_ids[]=all'
+               f'&assignment_ids[]={assignment_id}{include}')
+        if since is None:
+            yield from self.iterate(url)
+            return
+        yield from self.iterate(f'{url}&submitted_since={since}')
+        yield from self.iterate(f'{url}&graded_since={since}')
+
+    def changed_submissions(self, assignment_id, sync_key, include_user=True,
+                            include_history=True):
+        """ Returns a dictionary by ID of the submissions of an assignment
+        that are new or changed (new attempt, or graded again) since the
+        previous sync with the same key (which should identify the caller
+        and its output), and the new sync state. The state must be passed to
+        save_sync once the submissions have been processed; its 'updated'
+        entry lists the changed submissions that a previous sync already
+        returned. The state is only kept between runs if a cache directory
+        is in use; otherwise, all submissions are returned. """
+        key_hash = hashlib.sha1(str(sync_key).encode()).hexdigest()[:12]
+        state_name = f'submissions_{assignment_id}_{key_hash}'
+        state = self.load_state(state_name) or {'watermark': None, 'versions': {}}
+        started = sync_watermark()
+        changed = {}
+        updated = []
+        for submission in self.iterate_submissions_since(
+                assignment_id, state['watermark'], include_user, include_history):
+            version = [submission.get('attempt'), submission.get('submitted_at'),
+                       submission.get('graded_at')]
+            previous = state['versions'].get(str(submission['id']))
+            if previous != version and submission['id'] not in changed:
+                if previous is not None:
+                    updated.append(submission['id'])
+                state['versions'][str(submission['id'])] = version
+                changed[submission['id']] = submission
+        state['watermark'] = started
+        return (changed, {'name': state_name, 'state': state, 'updated': updated})
+
+    def save_sync(self, sync):
+        """ Saves a sync state returned by changed_submissions, so that the
+        next sync only returns the submissions changed after it """
+        self.save_state(sync['name'], sync['state'])
 
 
 class CourseSubObject(Canvas):
@@ -220,7 +1238,8 @@ class CourseSubObject(Canvas):
     def __init__(self, parent, route_name, data, id_field='id', request_param_name=None):
         # MUST be available before calling self.get_course.
         self.parent = parent
-        super().__init__(self.get_course().token)
+        course = self.get_course()
+        super().__init__(course.token, session=course.session)
 
         self.data = data
         self.id_field = id_field
@@ -256,7 +1275,11 @@ class CourseSubObject(Canvas):
         """ docstring """
         return self.data.items()
 
+    def invalidate(self):
+        """ Discards the data cached for the children of the object """
+
     def update(self, data=None):
+        previous_id = self.id
         if data:
             self.data = data
         if self.id:
@@ -267,6 +1290,11 @@ class CourseSubObject(Canvas):
                                   {self.route_name: self.data})
         self.id = self.compute_id()
         self.url_prefix = self.compute_url_prefix()
+        if self.id != previous_id:
+            # This is a new object: its children (if any) are not those of
+            # the object it was copied from, and the parent's lists are stale
+            self.invalidate()
+            self.parent.invalidate()
         return self
 
 
@@ -275,6 +1303,13 @@ class Quiz(CourseSubObject):
 
     def __init__(self, course, quiz_data):
         super().__init__(course, "quizzes", quiz_data)
+        # Questions (in listing order) and groups, by ID, once retrieved
+        self.question_cache = None
+        self.group_cache = {}
+
+    def invalidate(self):
+        self.question_cache = None
+        self.group_cache = {}
 
     def update_quiz(self, data=None):
         """ docstring """
@@ -284,82 +1319,73 @@ class Quiz(CourseSubObject):
         """ docstring """
         if group_id is None:
             return None
-        for group in self.request(f'{self.url_prefix}/groups/{group_id}'):
-            return group
-        return None
+        if group_id not in self.group_cache:
+            for group in self.request(f'{self.url_prefix}/groups/{group_id}'):
+                self.group_cache[group_id] = group
+                break
+            else:
+                return None
+        return copy.deepcopy(self.group_cache[group_id])
 
     # If group_id is None, creates a new one
     def update_question_group(self, group_id, group_data):
         """ docstring """
         if group_id:
-            return self.put(f'{self.url_prefix}/groups/{group_id}', {'quiz_groups': [group_data]})
-        return self.post(f'{self.url_prefix}/groups', {'quiz_groups': [group_data]})
+            result = self.put(f'{self.url_prefix}/groups/{group_id}', {'quiz_groups': [group_data]})
+        else:
+            result = self.post(f'{self.url_prefix}/groups', {'quiz_groups': [group_data]})
+        for group in result['quiz_groups']:
+            self.group_cache[group['id']] = copy.deepcopy(group)
+        return result
 
     def questions(self, qfilter=None):
-        """ docstring """
-        questions = {}
-        groups = {}
-        i = 1
-        for result in self.request(f'{self.url_prefix}/questions?per_page=100'):
-            for question in result:
-                if question['quiz_group_id'] in groups:
-                    group = groups[question['quiz_group_id']]
-                else:
-                    group = self.question_group(question['quiz_group_id'])
-                    groups[question['quiz_group_id']] = group
-
-                if group:
-                    question['points_possible'] = group['question_points']
-                    question['position'] = group['position']
-                else:
-                    question['position'] = i
-                    i += 1
-                if not qfilter or qfilter(question['id']):
-                    questions[question['id']] = question
-        if None in groups:
-            del groups[None]
-        for grp in groups.values():
-            for question in [
-                    q for q in questions.values() if q['position'] >= grp['position'] and q['quiz_group_id'] is None]:
-                question['position'] += 1
-        return (OrderedDict(sorted(questions.items(), key=lambda t: t[1]['position'])),
-                OrderedDict(sorted(groups.items(), key=lambda t: t[1]['position'])))
+        """ Returns the questions and groups of the quiz, sorted by
+        position. They are only retrieved the first time (and after
+        reorder_questions); callers get their own copies. """
+        if self.question_cache is None:
+            self.question_cache = {question['id']: question for question in
+                                   self.iterate(f'{self.url_prefix}/questions')}
+        question_list = copy.deepcopy(list(self.question_cache.values()))
+        group_ids = list(dict.fromkeys(question['quiz_group_id'] for question in question_list))
+        with ThreadPoolExecutor(max_workers=self.session.pool_size) as executor:
+            groups = dict(zip(group_ids, executor.map(self.question_group, group_ids)))
+        return sort_questions(question_list, groups, qfilter)
 
     def update_question(self, question_id, question):
         """ docstring """
-        # Reformat question data to account for different format
-        # between input and output in Canvas API
-        if 'answers' in question:
-            for answer in question['answers']:
-                if 'html' in answer:
-                    answer['answer_html'] = answer['html']
-                if question['question_type'] == 'matching_question':
-                    if 'left' in answer:
-                        answer['answer_match_left'] = answer['left']
-                    if 'right' in answer:
-                        answer['answer_match_right'] = answer['right']
-                if question['question_type'] == 'multiple_dropdowns_question':
-                    if 'weight' in answer:
-                        answer['answer_weight'] = answer['weight']
-                    if 'text' in answer:
-                        answer['answer_text'] = answer['text']
+        format_question_answers(question)
         # Update
         if question_id:
-            return self.put(f'{self.url_prefix}/questions/{question_id}', {'question': question})
-        return self.post(f'{self.url_prefix}/questions', {'question': question})
+            result = self.put(f'{self.url_prefix}/questions/{question_id}', {'question': question})
+        else:
+            result = self.post(f'{self.url_prefix}/questions', {'question': question})
+        self.cache_question(result)
+        return result
+
+    def cache_question(self, question):
+        """ Updates the cached copy of a question after it was saved """
+        if self.question_cache is not None:
+            self.question_cache[question['id']] = copy.deepcopy(question)
 
     def delete_question(self, question_id):
         """ docstring """
-        return self.delete(f'{self.url_prefix}/questions/{question_id}')
+        result = self.delete(f'{self.url_prefix}/questions/{question_id}')
+        if self.question_cache is not None:
+            self.question_cache.pop(question_id, None)
+        return result
 
     def reorder_questions(self, items):
         """ docstring """
-        return self.post(f'{self.url_prefix}/reorder', {'order': items})
+        result = self.post(f'{self.url_prefix}/reorder', {'order': items})
+        # Positions of questions and groups have changed
+        self.invalidate()
+        return result
 
     def submissions(self, include_user=True,
                     include_submission=True, include_history=True,
                     include_settings_only=False):
-        """ docstring """
+        """ Returns the list of quiz submissions, and a dictionary of the
+        corresponding (assignment) submissions by ID """
         submissions = {}
         quiz_submissions = []
         include = ''.join([
@@ -367,7 +1393,7 @@ class Quiz(CourseSubObject):
             'include[]=submission&' if include_submission else '',
             'include[]=submission_history&' if include_history else '',
         ])
-        for response in self.request(f'{self.url_prefix}/submissions?{include}'):
+        for response in self.iterate_pages(f'{self.url_prefix}/submissions?{include}'):
             quiz_submissions += [
                 qs for qs in response['quiz_submissions']
                 if include_settings_only or qs['workflow_state'] != 'settings_only'
@@ -377,22 +1403,89 @@ class Quiz(CourseSubObject):
                     submissions[submission['id']] = submission
         return (quiz_submissions, submissions)
 
+    def changed_submissions(self, sync_key, include_user=True, include_history=True,
+                            include_settings_only=False):
+        """ Returns the quiz submissions whose (assignment) submissions are
+        new or changed since the previous sync with the same key, the
+        dictionary of those submissions by ID, and the new sync state, to be
+        saved once they have been processed (see Course.changed_submissions) """
+        course = self.get_course()
+        (submissions, sync) = course.changed_submissions(
+            self.data['assignment_id'], sync_key, include_user, include_history)
+        (quiz_submissions, _) = self.submissions(
+            include_user=False, include_submission=False, include_history=False,
+            include_settings_only=include_settings_only)
+        return ([qs for qs in quiz_submissions if qs['submission_id'] in submissions],
+                submissions, sync)
+
+    def iterate_submissions(self, include_user=True, include_history=True,
+                            include_settings_only=False):
+        """ Generator of (quiz_submission, submission) pairs, yielded as
+        each page of quiz submissions arrives, so that only one page is
+        held in memory at a time. A quiz submission whose submission is
+        not found is yielded with None. """
+        include = ''.join([
+            'include[]=user&' if include_user else '',
+            'include[]=submission&',
+            'include[]=submission_history&' if include_history else '',
+        ])
+        # Canvas returns the submissions of the quiz submissions in each
+        # page, but, just in case, unmatched ones are kept until the end
+        # (except those of the quiz submissions that are left out)
+        waiting = {}
+        unmatched = {}
+        for page in self.iterate_pages(f'{self.url_prefix}/submissions?{include}'):
+            quiz_submissions = list(waiting.values()) + [
+                qs for qs in page['quiz_submissions']
+                if include_settings_only or qs['workflow_state'] != 'settings_only'
+            ]
+            left_out = {qs['submission_id'] for qs in page['quiz_submissions']} - \
+                {qs['submission_id'] for qs in quiz_submissions}
+            unmatched.update((submission['id'], submission) for submission in page['submissions']
+                             if submission['id'] not in left_out)
+            del page
+            waiting = {}
+            for qs in quiz_submissions:
+                if qs['submission_id'] in unmatched:
+                    yield (qs, unmatched.pop(qs['submission_id']))
+                else:
+                    waiting[qs['submission_id']] = qs
+        for qs in waiting.values():
+            yield (qs, None)
+
     def submission_questions(self, quiz_submission):
         """ docstring """
-        questions = {}
-        for result in self.request(f"/quiz_submissions/{quiz_submission['id']}/questions"):
-            for question in result['quiz_submission_questions']:
-                questions[question['id']] = question
-        return questions
+        return {question['id']: question for question in self.iterate(
+            f"/quiz_submissions/{quiz_submission['id']}/questions",
+            key='quiz_submission_questions')}
+
+    def prefetch_submission_questions(self, quiz_submissions, window=None):
+        """ Generator of (quiz_submission, questions) for each of the quiz
+        submissions, in order, as returned by submission_questions. The
+        questions are retrieved concurrently (up to the session pool size),
+        at most window submissions ahead of the consumer. The quiz
+        submissions may also be given (and are then yielded) as the
+        (quiz_submission, submission) pairs of iterate_submissions. """
+        def questions(item):
+            return self.submission_questions(item[0] if isinstance(item, tuple) else item)
+        return prefetch(questions, quiz_submissions, self.session.pool_size, window)
 
     def send_quiz_grade(self, quiz_submission,
                         question_id, points, comments=None):
         """ docstring """
-        self.put(f"{self.url_prefix}/submissions/{quiz_submission['id']}",
-                 {'quiz_submissions': [{
-                     'attempt': quiz_submission['attempt'],
-                     'questions': {question_id: {'score': points, 'comment': comments}}
-                 }]})
+        self.send_quiz_grades(quiz_submission,
+                              {question_id: {'score': points, 'comment': comments}})
+
+    def send_quiz_grades(self, quiz_submission, questions, fudge_points=None, attempt=None):
+        """ Updates the scores of several questions of a quiz submission in
+        a single request. questions maps question IDs to dictionaries
+        with a 'score' and (optionally) a 'comment'. The attempt defaults
+        to the current attempt of the quiz submission. """
+        grades = {'attempt': attempt or quiz_submission['attempt'], 'questions': questions}
+        if fudge_points is not None:
+            grades['fudge_points'] = fudge_points
+        return self.put(f"{self.url_prefix}/submissions/{quiz_submission['id']}",
+                        {'quiz_submissions': [grades]})
 
 
 class QuizQuestion(CourseSubObject):
@@ -408,25 +1501,10 @@ class QuizQuestion(CourseSubObject):
     def update(self, data=None):
         if data:
             self.data = data
-
-        # Reformat question data to account for different format
-        # between input and output in Canvas API
-        if 'answers' in self.data:
-            for answer in self.data['answers']:
-                if 'html' in answer:
-                    answer['answer_html'] = answer['html']
-                if self.data['question_type'] == 'matching_question':
-                    if 'left' in answer:
-                        answer['answer_match_left'] = answer['left']
-                    if 'right' in answer:
-                        answer['answer_match_right'] = answer['right']
-                if self.data['question_type'] == 'multiple_dropdowns_question':
-                    if 'weight' in answer:
-                        answer['answer_weight'] = answer['weight']
-                    if 'text' in answer:
-                        answer['answer_text'] = answer['text']
-
-        return super().update(self.data)
+        format_question_answers(self.data)
+        super().update(self.data)
+        self.parent.cache_question(self.data)
+        return self
 
     def update_question(self, data=None):
         return self.update(data)
@@ -437,16 +1515,26 @@ class Assignment(CourseSubObject):
 
     def __init__(self, course, assg_data):
         super().__init__(course, "assignments", assg_data)
+        self.rubric_cache = None
+
+    def invalidate(self):
+        self.rubric_cache = None
 
     def update_assignment(self, data=None):
         return self.update(data)
 
     def rubric(self):
-        """ docstring """
-        for result in self.request(
-                f"{self.course.url_prefix}/rubrics/{self.data['rubric_settings']['id']}?include[]=associations"):
-            return result
-        return None
+        """ Returns the rubric of the assignment, which is only retrieved
+        the first time """
+        if self.rubric_cache is None:
+            for result in self.request(
+                    f"{self.get_course().url_prefix}/rubrics/"
+                    f"{self.data['rubric_settings']['id']}?include[]=associations"):
+                self.rubric_cache = result
+                break
+            else:
+                return None
+        return copy.deepcopy(self.rubric_cache)
 
     def update_rubric(self, rubric):
         """ docstring """
@@ -459,13 +1547,78 @@ class Assignment(CourseSubObject):
                 'purpose': 'grading',
             },
         }
-        self.post(f'{self.course.url_prefix}/rubrics', rubric_data)
+        result = self.post(f'{self.get_course().url_prefix}/rubrics', rubric_data)
+        # Reflect the new rubric in the assignment, as Canvas would
+        rubric = result.get('rubric') or {}
+        self.rubric_cache = None
+        if 'data' in rubric:
+            self.data['rubric'] = rubric['data']
+            self.data['rubric_settings'] = {
+                key: rubric.get(key) for key in
+                ['id', 'title', 'points_possible', 'free_form_criterion_comments']}
+        else:
+            for assignment in self.request(self.url_prefix):
+                self.data = assignment
+        return result
+
+    def submissions(self, include_user=True, include_history=False):
+        """ Returns a dictionary of the submissions of the assignment by ID """
+        include = ''.join([
+            'include[]=user&' if include_user else '',
+            'include[]=submission_history&' if include_history else '',
+        ])
+        return {submission['id']: submission for submission in
+                self.iterate(f'{self.url_prefix}/submissions?{include}')}
+
+    def changed_submissions(self, sync_key, include_user=True, include_history=False):
+        """ Returns a dictionary of the submissions of the assignment that
+        changed since the previous sync with the same key, and the new sync
+        state (see Course.changed_submissions) """
+        return self.get_course().changed_submissions(self.id, sync_key, include_user,
+                                                     include_history)
 
     def send_assig_grade(self, student, assessment):
         """ docstring """
         self.put(
             f"{self.url_prefix}/submissions/{student['id']}", {'rubric_assessment': assessment})
 
+    def send_assig_grades(self, assessments, chunk_size=GRADE_CHUNK_SIZE):
+        """ Sends the rubric assessments of many students (a dictionary by
+        student ID) with the bulk update_grades endpoint, chunk_size
+        students per request. Canvas applies each chunk in the background,
+        so its progress is polled until done; the students of a chunk that
+        failed are then sent one at a time, to find out which ones fail.
+        Returns a dictionary of error messages by student ID. """
+        student_ids = list(assessments)
+        chunks = [student_ids[i:i + chunk_size]
+                  for i in range(0, len(student_ids), chunk_size)]
+        # All chunks are submitted first, so that Canvas can work on them
+        # while the first ones are polled. A chunk whose request fails is
+        # handled like a chunk whose progress failed.
+        progresses = []
+        for chunk in chunks:
+            try:
+                progresses.append(self.post(
+                    f'{self.url_prefix}/submissions/update_grades',
+                    {'grade_data': {student_id: {'rubric_assessment': assessments[student_id]}
+                                    for student_id in chunk}}))
+            except requests.RequestException:
+                progresses.append(None)
+        errors = {}
+        for (chunk, progress) in zip(chunks, progresses):
+            try:
+                if progress is not None and \
+                   self.wait_progress(progress)['workflow_state'] == 'completed':
+                    continue
+            except requests.RequestException:
+                pass
+            for student_id in chunk:
+                try:
+                    self.send_assig_grade({'id': student_id}, assessments[student_id])
+                except requests.RequestException as error:
+                    errors[student_id] = str(error)
+        return errors
+
 
 class Page(CourseSubObject):
 
@@ -475,3 +1628,313 @@ class Page(CourseSubObject):
 
     def update_page(self, data=None):
         return self.update(data)
+
+
+class CourseMirror:
+    """ Local copy of course data (quizzes, questions, assignments, rubrics,
+    pages, students and submissions) in an SQLite database. Objects are
+    stored as JSON, indexed by course, type, ID and parent. The mirror may
+    be shared by threads (e.g., in batch mode). """
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS objects (
+                               course_id INTEGER, type TEXT, id TEXT, parent_id TEXT,
+                               position INTEGER, updated_at TEXT, data TEXT,
+                               PRIMARY KEY (course_id, type, id))''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS objects_parent
+                           ON objects (course_id, type, parent_id)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS sync (
+                               course_id INTEGER, name TEXT, value TEXT,
+                               PRIMARY KEY (course_id, name))''')
+        self.db.commit()
+
+    def store(self, course_id, obj_type, obj_id, data, parent_id=None,
+              position=None, updated_at=None):
+        """ docstring """
+        with self.lock:
+            self.db.execute('''INSERT OR REPLACE INTO objects
+                               (course_id, type, id, parent_id, position, updated_at, data)
+                               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                            (course_id, obj_type, str(obj_id),
+                             None if parent_id is None else str(parent_id),
+                             position, updated_at, json.dumps(data)))
+
+    def store_all(self, course_id, obj_type, items, parent_id=None, id_field='id'):
+        """ Replaces all objects of a type (and parent) with the given list """
+        with self.lock:
+            self.delete(course_id, obj_type, parent_id)
+            for (position, item) in enumerate(items):
+                self.store(course_id, obj_type, item[id_field], item, parent_id,
+                           position, item.get('updated_at'))
+
+    def delete(self, course_id, obj_type, parent_id=None):
+        """ docstring """
+        with self.lock:
+            if parent_id is None:
+                self.db.execute('DELETE FROM objects WHERE course_id = ? AND type = ?',
+                                (course_id, obj_type))
+            else:
+                self.db.execute('''DELETE FROM objects
+                                   WHERE course_id = ? AND type = ? AND parent_id = ?''',
+                                (course_id, obj_type, str(parent_id)))
+
+    def delete_object(self, course_id, obj_type, obj_id):
+        """ docstring """
+        with self.lock:
+            self.db.execute('DELETE FROM objects WHERE course_id = ? AND type = ? AND id = ?',
+                            (course_id, obj_type, str(obj_id)))
+
+    def delete_orphans(self, course_id, obj_type, parent_ids):
+        """ Deletes the objects of a type whose parent is not one of the
+        given IDs (e.g., the questions of deleted quizzes) """
+        with self.lock:
+            parents = [str(parent_id) for parent_id in parent_ids]
+            self.db.execute(f'''DELETE FROM objects WHERE course_id = ? AND type = ?
+                                AND parent_id NOT IN ({', '.join('?' * len(parents))})''',
+                            [course_id, obj_type] + parents)
+
+    def get(self, course_id, obj_type, obj_id):
+        """ docstring """
+        with self.lock:
+            row = self.db.execute('''SELECT data FROM objects
+                                     WHERE course_id = ? AND type = ? AND id = ?''',
+                                  (course_id, obj_type, str(obj_id))).fetchone()
+            return json.loads(row[0]) if row else None
+
+    def all(self, course_id, obj_type, parent_id=None):
+        """ Returns all objects of a type (and parent), in listing order """
+        with self.lock:
+            if parent_id is None:
+                rows = self.db.execute('''SELECT data FROM objects
+                                          WHERE course_id = ? AND type = ?
+                                          ORDER BY position''', (course_id, obj_type))
+            else:
+                rows = self.db.execute('''SELECT data FROM objects
+                                          WHERE course_id = ? AND type = ? AND parent_id = ?
+                                          ORDER BY position''',
+                                       (course_id, obj_type, str(parent_id)))
+            return [json.loads(data) for (data,) in rows]
+
+    def versions(self, course_id, obj_type):
+        """ Returns the updated_at value of each object of a type, by ID """
+        with self.lock:
+            return dict(self.db.execute('''SELECT id, updated_at FROM objects
+                                            WHERE course_id = ? AND type = ?''',
+                                        (course_id, obj_type)).fetchall())
+
+    def sync_value(self, course_id, name):
+        """ docstring """
+        with self.lock:
+            row = self.db.execute('SELECT value FROM sync WHERE course_id = ? AND name = ?',
+                                  (course_id, name)).fetchone()
+            return row[0] if row else None
+
+    def set_sync_value(self, course_id, name, value):
+        """ docstring """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO sync (course_id, name, value) VALUES (?, ?, ?)',
+                            (course_id, name, value))
+
+    def course(self, canvas, course_id):
+        """ Returns a course backed by the mirror """
+        data = self.get(course_id, 'course', course_id)
+        if data is None:
+            raise RuntimeError(f'Course {course_id} not found in mirror, use mirror.py first.')
+        return MirrorCourse(canvas, data, self)
+
+    def sync(self, course, submissions=True, log=print):
+        """ Updates the mirror of a course. The lists of quizzes,
+        assignments, rubrics, pages and students are downloaded again, but
+        the questions of a quiz and the content of a page are only
+        downloaded if its updated_at changed, and submissions only if they
+        were submitted or graded since the previous sync (the quiz
+        submissions of a quiz are downloaded again if any of them was). """
+        cid = course.id
+        self.store(cid, 'course', cid, course.data)
+
+        log('Synchronizing quizzes...')
+        quiz_versions = self.versions(cid, 'quiz')
+        quizzes = course.quizzes()
+        self.store_all(cid, 'quiz', [quiz.data for quiz in quizzes])
+        for obj_type in ('quiz_group', 'quiz_question', 'quiz_submission'):
+            self.delete_orphans(cid, obj_type, [quiz.id for quiz in quizzes])
+        for quiz in quizzes:
+            if quiz_versions.get(str(quiz.id)) != quiz['updated_at']:
+                log(f"  Questions of quiz: {quiz['title']}")
+                (questions, groups) = quiz.questions()
+                self.store_all(cid, 'quiz_group', list(groups.values()), quiz.id)
+                self.store_all(cid, 'quiz_question', list(questions.values()), quiz.id)
+
+        log('Synchronizing assignments and rubrics...')
+        assignments = [Assignment(course, assn) for assn in
+                       course.iterate(f'{course.url_prefix}/assignments')]
+        self.store_all(cid, 'assignment', [assn.data for assn in assignments])
+        self.delete_orphans(cid, 'submission', [assn.id for assn in assignments])
+        self.store_all(cid, 'rubric', course.rubrics())
+
+        log('Synchronizing pages...')
+        versions = self.versions(cid, 'page')
+        listing = list(course.iterate(f'{course.url_prefix}/pages'))
+        stale = [page['url'] for page in listing
+                 if versions.get(page['url']) != page['updated_at']]
+        with ThreadPoolExecutor(max_workers=course.session.pool_size) as executor:
+            pages = dict(zip(stale, executor.map(course.fetch_page, stale)))
+        for (position, page_data) in enumerate(listing):
+            page = pages.get(page_data['url'])
+            data = page.data if page else self.get(cid, 'page', page_data['url'])
+            if data is not None:
+                self.store(cid, 'page', page_data['url'], data,
+                           position=position, updated_at=page_data['updated_at'])
+        current = {page['url'] for page in listing}
+        for url in set(versions) - current:
+            self.delete_object(cid, 'page', url)
+
+        log('Synchronizing students...')
+        self.store_all(cid, 'student', list(course.roster()))
+
+        if submissions:
+            log('Synchronizing submissions...')
+            changed = {assn.id for assn in assignments if self.sync_submissions(course, assn.id)}
+            for quiz in quizzes:
+                if quiz['assignment_id'] in changed or str(quiz.id) not in quiz_versions:
+                    log(f"  Submissions of quiz: {quiz['title']}")
+                    (quiz_submissions, _) = quiz.submissions(
+                        include_user=False, include_submission=False,
+                        include_history=False, include_settings_only=True)
+                    self.store_all(cid, 'quiz_submission', quiz_submissions, quiz.id)
+        with self.lock:
+            self.db.commit()
+
+    def sync_submissions(self, course, assignment_id):
+        """ Downloads the submissions (with history) of an assignment that
+        were submitted or graded since the previous sync, and returns how
+        many there were """
+        name = f'submissions_{assignment_id}'
+        started = sync_watermark()
+        count = 0
+        for submission in course.iterate_submissions_since(
+                assignment_id, self.sync_value(course.id, name)):
+            self.store(course.id, 'submission', submission['id'], submission, assignment_id,
+                       updated_at=max(submission.get('submitted_at') or '',
+                                      submission.get('graded_at') or ''))
+            count += 1
+        self.set_sync_value(course.id, name, started)
+        return count
+
+
+class MirrorCourse(Course):
+    """ Course whose data is read from a CourseMirror. Updates are still
+    sent to Canvas, and are only reflected in the mirror after the next
+    sync. """
+
+    def __init__(self, canvas, course_data, mirror):
+        super().__init__(canvas, course_data)
+        self.mirror = mirror
+
+    def page(self, url):
+        data = self.mirror.get(self.id, 'page', url)
+        return Page(self, data) if data else None
+
+    def pages(self):
+        return [Page(self, page) for page in self.mirror.all(self.id, 'page')]
+
+    def new_quiz(self, quiz_data):
+        return MirrorQuiz(self, quiz_data)
+
+    def new_assignment(self, assignment_data):
+        return MirrorAssignment(self, assignment_data)
+
+    def quizzes(self):
+        if self.quiz_list is None:
+            self.quiz_list = [self.cached_quiz(quiz) for quiz in self.mirror.all(self.id, 'quiz')
+                              if quiz['quiz_type'] == 'assignment']
+        return list(self.quiz_list)
+
+    def quiz(self, quiz_id, prompt_if_needed=False):
+        if quiz_id:
+            quiz = self.quiz_cache.get(quiz_id)
+            if quiz is not None and quiz.id == quiz_id:
+                return quiz
+            data = self.mirror.get(self.id, 'quiz', quiz_id)
+            return self.cached_quiz(data) if data else None
+        return super().quiz(quiz_id, prompt_if_needed)
+
+    def assignments(self):
+        if self.assignment_list is None:
+            self.assignment_list = [self.cached_assignment(assn) for assn in
+                                    self.mirror.all(self.id, 'assignment')
+                                    if 'online_quiz' not in assn['submission_types']]
+        return list(self.assignment_list)
+
+    def assignment(self, assignment_id, prompt_if_needed=False):
+        if assignment_id:
+            assignment = self.assignment_cache.get(assignment_id)
+            if assignment is not None and assignment.id == assignment_id:
+                return assignment
+            data = self.mirror.get(self.id, 'assignment', assignment_id)
+            return self.cached_assignment(data) if data else None
+        return super().assignment(assignment_id, prompt_if_needed)
+
+    def rubrics(self):
+        return self.mirror.all(self.id, 'rubric')
+
+    def roster(self, max_age=0):
+        return Roster(self.mirror.all(self.id, 'student'))
+
+    def iterate_submissions_since(self, assignment_id, since=None,
+                                  include_user=True, include_history=True):
+        yield from self.assignment_submissions(assignment_id).values()
+
+    def assignment_submissions(self, assignment_id):
+        """ Returns the mirrored submissions of an assignment by ID """
+        return {submission['id']: submission for submission in
+                self.mirror.all(self.id, 'submission', assignment_id)}
+
+
+class MirrorQuiz(Quiz):
+    """ Quiz whose questions and submissions are read from a CourseMirror """
+
+    def __init__(self, course, quiz_data):
+        super().__init__(course, quiz_data)
+        self.request_param_name = 'quiz'
+
+    def questions(self, qfilter=None):
+        course = self.get_course()
+        groups = {group['id']: group
+                  for group in course.mirror.all(course.id, 'quiz_group', self.id)}
+        return sort_questions(course.mirror.all(course.id, 'quiz_question', self.id),
+                              groups, qfilter)
+
+    def submissions(self, include_user=True,
+                    include_submission=True, include_history=True,
+                    include_settings_only=False):
+        course = self.get_course()
+        quiz_submissions = [qs for qs in course.mirror.all(course.id, 'quiz_submission', self.id)
+                            if include_settings_only or qs['workflow_state'] != 'settings_only']
+        submissions = course.assignment_submissions(self['assignment_id']) \
+            if include_submission else {}
+        return (quiz_submissions, submissions)
+
+    def iterate_submissions(self, include_user=True, include_history=True,
+                            include_settings_only=False):
+        (quiz_submissions, submissions) = self.submissions(
+            include_settings_only=include_settings_only)
+        for qs in quiz_submissions:
+            yield (qs, submissions.get(qs['submission_id']))
+
+
+class MirrorAssignment(Assignment):
+    """ Assignment whose rubric and submissions are read from a CourseMirror """
+
+    def __init__(self, course, assg_data):
+        super().__init__(course, assg_data)
+        self.request_param_name = 'assignment'
+
+    def rubric(self):
+        course = self.get_course()
+        return course.mirror.get(course.id, 'rubric', self.data['rubric_settings']['id'])
+
+    def submissions(self, include_user=True, include_history=False):
+        return self.get_course().assignment_submissions(self.id)
@@ -9,79 +9,104 @@ import requests
 import weasyprint
 import zipfile
 import argparse
+import sys
 from collections import OrderedDict
 
 import canvas
 
 parser = argparse.ArgumentParser()
-canvas.Canvas.add_arguments(parser, quiz=True)
+canvas.Canvas.add_arguments(parser, quiz=True, batch=True)
 parser.add_argument("--practice", action='store_true',
                     help="Change quiz to be a practice quiz")
 parser.add_argument("--published", action='store_true',
                     help="By default, new quiz is set to unpublished. This option sets it as published.")
+parser.add_argument("--quiz-title",
+                    help="In batch mode, title of the quiz to duplicate in each course")
 args = parser.parse_args()
 
 canvas = canvas.Canvas(args=args)
 
-print('Reading data from Canvas...')
-course = canvas.course(args.course, prompt_if_needed=True)
-print('Using course: %s / %s' % (course['term']['name'],
-                                 course['course_code']))
+def find_quiz(course):
+    if args.quiz or not args.quiz_title:
+        return course.quiz(args.quiz, prompt_if_needed=True)
+    for quiz in course.quizzes():
+        if quiz['title'] == args.quiz_title:
+            return quiz
+    return None
 
-quiz = course.quiz(args.quiz, prompt_if_needed=True)
-print('Using quiz: %s' % (quiz['title']))
+def duplicate_quiz(course):
+    print('Using course: %s / %s' % (course['term']['name'],
+                                     course['course_code']))
 
-# Reading questions
-print('Retrieving quiz questions...')
-(questions, groups) = quiz.questions()
+    quiz = find_quiz(course)
+    if quiz is None:
+        raise ValueError('Quiz not found.')
+    print('Using quiz: %s' % (quiz['title']))
 
-if args.practice:
-    quiz['quiz_type'] = 'practice_quiz'
-    quiz['unlock_at'] = quiz['lock_at']
-    quiz['due_at'] = None
-    quiz['lock_at'] = None
-    quiz['allowed_attempts'] = -1
-    quiz['time_limit'] = None
-    quiz['show_correct_answers'] = True
-    quiz['show_correct_answers_at'] = None
-    quiz['title'] += ' (Practice Version)'
-else:
-    quiz['title'] += ' (copy)'
-quiz['published'] = args.published
-quiz.id = None
+    # Reading questions
+    print('Retrieving quiz questions...')
+    (questions, groups) = quiz.questions()
 
-print('Creating new quiz...')
-quiz.update_quiz()
+    if args.practice:
+        quiz['quiz_type'] = 'practice_quiz'
+        quiz['unlock_at'] = quiz['lock_at']
+        quiz['due_at'] = None
+        quiz['lock_at'] = None
+        quiz['allowed_attempts'] = -1
+        quiz['time_limit'] = None
+        quiz['show_correct_answers'] = True
+        quiz['show_correct_answers_at'] = None
+        quiz['title'] += ' (Practice Version)'
+    else:
+        quiz['title'] += ' (copy)'
+    quiz['published'] = args.published
+    quiz.id = None
 
-new_groups = {}
-print('Pushing question groups...')
-for (group_id, group) in groups.items():
-    group = quiz.update_question_group(None, group)['quiz_groups'][0]
-    new_groups[group_id] = group
+    print('Creating new quiz...')
+    quiz.update_quiz()
 
-new_questions = {}
-print('Pushing questions...')
-for (question_id, question) in questions.items():
-    if question['quiz_group_id'] in new_groups:
-        question['quiz_group_id'] = new_groups[question['quiz_group_id']]['id']
-    question = quiz.update_question(None, question)
-    questions[question_id] = question
-    new_questions[question['id']] = question
+    new_groups = {}
+    print('Pushing question groups...')
+    for (group_id, group) in groups.items():
+        group = quiz.update_question_group(None, group)['quiz_groups'][0]
+        new_groups[group_id] = group
 
-print('Updating question order...')
-order = []
-groups_ordered = set()
-for question in questions.values():
-    if question['quiz_group_id']:
-        if question['quiz_group_id'] not in groups_ordered:
-            order.append({'type': 'group',
-                          'id': question['quiz_group_id']})
-            groups_ordered.add(question['quiz_group_id'])
-    else:
-        order.append({'type': 'question',
-                      'id': question['id']})
-quiz.reorder_questions(order)
+    new_questions = {}
+    print('Pushing questions...')
+    for (question_id, question) in questions.items():
+        if question['quiz_group_id'] in new_groups:
+            question['quiz_group_id'] = new_groups[question['quiz_group_id']]['id']
+        question = quiz.update_question(None, question)
+        questions[question_id] = question
+        new_questions[question['id']] = question
 
-print('\nDONE. New quiz: ')
-print('\tTitle: %s' % quiz['title'])
-print('\tURL  : %s' % quiz['html_url'])
+    print('Updating question order...')
+    order = []
+    groups_ordered = set()
+    for question in questions.values():
+        if question['quiz_group_id']:
+            if question['quiz_group_id'] not in groups_ordered:
+                order.append({'type': 'group',
+                              'id': question['quiz_group_id']})
+                groups_ordered.add(question['quiz_group_id'])
+        else:
+            order.append({'type': 'question',
+                          'id': question['id']})
+    quiz.reorder_questions(order)
+
+    print('\nDONE. New quiz: ')
+    print('\tTitle: %s' % quiz['title'])
+    print('\tURL  : %s' % quiz['html_url'])
+
+print('Reading data from Canvas...')
+courses = canvas.batch_courses(args)
+if courses is None:
+    duplicate_quiz(canvas.course(args.course, prompt_if_needed=True))
+else:
+    # Quiz IDs are specific to a course, so quizzes are found by title
+    if args.quiz:
+        parser.error('--quiz cannot be used in batch mode, use --quiz-title')
+    if not args.quiz_title:
+        parser.error('--quiz-title is required in batch mode')
+    if canvas.run_batch(courses, duplicate_quiz, args.course_jobs):
+        sys.exit(1)
@@ -0,0 +1,24 @@
+#! /usr/bin/python3
+
+import argparse
+
+import canvas
+
+parser = argparse.ArgumentParser()
+canvas.Canvas.add_arguments(parser)
+parser.add_argument("database", help="SQLite database file of the mirror")
+parser.add_argument("--no-submissions", action='store_true',
+                    help="Do not download quiz and assignment submissions")
+args = parser.parse_args()
+if args.mirror:
+    parser.error('--mirror cannot be used when creating a mirror')
+mirror = canvas.CourseMirror(args.database)
+canvas = canvas.Canvas(args=args)
+
+print('Reading data from Canvas...')
+course = canvas.course(args.course, prompt_if_needed=True)
+print('Using course: %s / %s' % (course['term']['name'],
+                                 course['course_code']))
+
+mirror.sync(course, submissions=not args.no_submissions)
+print('Mirror updated: %s' % args.database)
@@ -80,7 +80,7 @@ def make_update_text(text_process_fn, text_fields, title_field=None):
     return update_text
 
 parser = BetterErrorParser()
-canvas.Canvas.add_arguments(parser)
+canvas.Canvas.add_arguments(parser, batch=True)
 
 
 parser.add_argument("-a", "--assignments", help="Process assignments.", action="store_true")
@@ -140,35 +140,41 @@ print('Object types being processed: %s%s%s' % \
     "quizzes " if process_quizzes else ""))
 
 
+def process_course(course):
+    print('Using course: %s / %s' % (course['term']['name'],
+                                     course['course_code']))
+
+    if process_assns:
+        print()
+        print("--------------------------------------------------------------------------")
+        print("Fetching assignments from Canvas...")
+        assignments = course.assignments()
+        print("Done fetching assignments from Canvas.")
+        update_objects(assignments, "assignment", update_assn_fn)
+
+    if process_pages:
+        print()
+        print("--------------------------------------------------------------------------")
+        print("Fetching pages from Canvas...")
+        pages = course.pages()
+        print("Done fetching pages from Canvas.")
+        update_objects(pages, "page", update_page_fn)
+
+    if process_quizzes:
+        print()
+        print("--------------------------------------------------------------------------")
+        print("Fetching quizzes from Canvas...")
+        quizzes = course.quizzes()
+        print("Done fetching quizzes from Canvas.")
+        update_objects(quizzes, "quiz", update_quiz_fn)
+
+
 print('Reading data from Canvas...')
-course = canvasObj.course(args.course, prompt_if_needed=True)
-print('Using course: %s / %s' % (course['term']['name'],
-                                 course['course_code']))
-
-
-if process_assns:
-    print()
-    print("--------------------------------------------------------------------------")
-    print("Fetching assignments from Canvas...")
-    assignments = course.assignments()
-    print("Done fetching assignments from Canvas.")
-    update_objects(assignments, "assignment", update_assn_fn)
-
-if process_pages:
-    print()
-    print("--------------------------------------------------------------------------")
-    print("Fetching pages from Canvas...")
-    pages = course.pages()
-    print("Done fetching pages from Canvas.")
-    update_objects(pages, "page", update_page_fn)
-
-if process_quizzes:
-    print()
-    print("--------------------------------------------------------------------------")
-    print("Fetching quizzes from Canvas...")
-    quizzes = course.quizzes()
-    print("Done fetching quizzes from Canvas.")
-    update_objects(quizzes, "quiz", update_quiz_fn)
+courses = canvasObj.batch_courses(args)
+if courses is None:
+    process_course(canvasObj.course(args.course, prompt_if_needed=True))
+elif canvasObj.run_batch(courses, process_course, args.course_jobs):
+    sys.exit(1)
 
 
 
@@ -1,6 +1,7 @@
 #! /usr/bin/python3
 
 import os
+import sys
 import csv
 import re
 from os import path
@@ -12,10 +13,40 @@ import argparse
 
 import canvas
 
+def read_columns(file_name):
+    """ Reads a CSV file into a dictionary of columns by header, returning
+    the SID column and the dictionary. Missing cells at the end of a row
+    are empty. """
+    with open(file_name, 'r', newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        rows = [row + [''] * (len(header) - len(row)) for row in reader if row]
+    columns = dict(zip(header, map(list, zip(*rows)))) if rows else \
+        {name: [] for name in header}
+    if 'SID' not in columns or 'TOTAL' not in columns:
+        raise ValueError('Marks file does not contain SID or TOTAL.')
+    return (columns['SID'], columns)
+
+def number_column(columns, name, sids, errors):
+    """ Converts a column to numbers (empty cells are 0), adding an error
+    for each cell that is not a number """
+    values = []
+    for (sid, cell) in zip(sids, columns[name]):
+        try:
+            values.append(float(cell) if cell.strip() else 0.0)
+        except ValueError:
+            errors.append('Student %s: invalid %s value "%s"' % (sid, name, cell))
+            values.append(0.0)
+    return values
+
 parser = argparse.ArgumentParser()
 canvas.Canvas.add_arguments(parser, assignment=True)
 parser.add_argument("-p", "--parts", help="CSV file with assignment parts")
 parser.add_argument("-m", "--marks", help="CSV file with assignment marks")
+parser.add_argument("--tolerance", type=float, default=0.05,
+                    help="Maximum difference between TOTAL (x 100) and the computed total")
+parser.add_argument("--force", action='store_true',
+                    help="Send the grades even if some marks are invalid or do not add up")
 args = parser.parse_args()
 canvas = canvas.Canvas(args=args)
 
@@ -28,7 +59,7 @@ assignment = course.assignment(args.assignment, prompt_if_needed=True)
 print('Using assignment: %s' % (assignment['name']))
 
 # Reading students
-students = course.students()
+roster = course.roster(max_age=args.roster_max_age)
 
 # Reading parts CSV file
 if args.parts:
@@ -74,39 +105,63 @@ if args.marks:
         print('ERROR: Assignment has not been set up with a rubric.')
         exit(0)
 
-    with open(args.marks, 'r', newline='') as file:
-        marks = csv.DictReader(file)
-        i = 0
-        for mark in marks:
-            i += 1
-            print('Pushing grade %d...' % i, end='\r')
-            if mark['SID'] not in students:
-                print('\nIgnoring student %s, not on Canvas.' % mark['SID'])
-                continue
-            student = students[mark['SID']]
-            total = float(mark['TOTAL']) * 100
-            comments = ''
-            penaltypc = float(mark['PENALTY']) if 'PENALTY' in mark else 0.0
-            penaltyreason = mark['PENALTYREASON'] if 'PENALTYREASON' in mark else ''
-            if 'INPROGRESS' in mark:
-                comments += '%s\n' % mark['INPROGRESS']
-            assess = {}
-            totalcalc = 0
-            for rub in assignment['rubric']:
-                rubpoints = round(float(mark[rub['id']]) * rub['points'], 2) \
-                            if rub['id'] in mark else 0
-                rubcomments = mark['Comments__' + rub['id']] \
-                              if 'Comments__' + rub['id'] in mark else None
-                totalcalc += rubpoints
-                assess[rub['id']] = {'points': rubpoints,
-                                     'comments': rubcomments}
-            penalty = round(penaltypc * totalcalc / 100.0, 2)
-            # TODO Ensure total == totalcalc - penalty within a tolerance
-            assess['PENALTY'] = {
-                'points': -penalty,
-                'comments': penaltyreason
-            }
-            # TODO General comments
-            assignment.send_assig_grade(student, assess)
+    # All marks are read, computed and checked before any grade is sent
+    print('Checking marks...')
+    (sids, columns) = read_columns(args.marks)
+    rubric = assignment['rubric']
+    errors = []
+    points = {}
+    for rub in rubric:
+        if rub['id'] in columns and rub['id'] != 'PENALTY':
+            points[rub['id']] = [round(value * rub['points'], 2) for value in
+                                 number_column(columns, rub['id'], sids, errors)]
+        else:
+            points[rub['id']] = [0] * len(sids)
+    totalcalc = [sum(row) for row in zip(*points.values())] \
+        if points else [0] * len(sids)
+    penaltypc = number_column(columns, 'PENALTY', sids, errors) \
+        if 'PENALTY' in columns else [0.0] * len(sids)
+    penalties = [round(pc * tc / 100.0, 2) for (pc, tc) in zip(penaltypc, totalcalc)]
+    totals = [value * 100 for value in number_column(columns, 'TOTAL', sids, errors)]
+    for (sid, total, tc, penalty) in zip(sids, totals, totalcalc, penalties):
+        if abs(total - (tc - penalty)) > args.tolerance:
+            errors.append('Student %s: TOTAL is %.2f, but marks add up to %.2f' %
+                          (sid, total, tc - penalty))
+    students = [roster.find(sid, fields=('sis_user_id',)) for sid in sids]
+    if None in students and args.roster_max_age:
+        # The saved roster may predate recent enrollments
+        roster = course.roster()
+        students = [roster.find(sid, fields=('sis_user_id',)) for sid in sids]
+    for (sid, student) in zip(sids, students):
+        if student is None:
+            print('Ignoring student %s, not on Canvas.' % sid)
+    if errors:
+        for error in errors:
+            print('ERROR: %s' % error)
+        if not args.force:
+            print('No grades were sent. Fix the marks file or use --force.')
+            sys.exit(1)
+
+    empty = [None] * len(sids)
+    assessments = {}
+    student_sids = {}
+    for (i, (sid, student)) in enumerate(zip(sids, students)):
+        if student is None:
+            continue
+        assess = {rub['id']: {'points': points[rub['id']][i],
+                              'comments': columns.get('Comments__' + rub['id'], empty)[i]}
+                  for rub in rubric}
+        assess['PENALTY'] = {
+            'points': -penalties[i],
+            'comments': columns.get('PENALTYREASON', [''] * len(sids))[i]
+        }
+        # TODO General comments (e.g., INPROGRESS column)
+        assessments[student['id']] = assess
+        student_sids[student['id']] = sid
+
+    print('Pushing %d grades...' % len(assessments))
+    errors = assignment.send_assig_grades(assessments)
+    for (student_id, error) in errors.items():
+        print('ERROR: grade of student %s not updated: %s' % (student_sids[student_id], error))
 
 print('\nDONE.')
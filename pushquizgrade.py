@@ -1,24 +1,55 @@
 #! /usr/bin/python3
 
+import os
 import sys
 import csv
 import re
 import json
+import hashlib
 import zipfile
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import canvas
 
+def same_score(old, new):
+    try:
+        return old is not None and float(old) == float(new)
+    except ValueError:
+        return False
+
+def batch_key(qs, questions, fudge_points):
+    digest = hashlib.sha1(json.dumps([questions, fudge_points], sort_keys=True).encode())
+    return f"{qs['id']}:{qs['attempt']}:{digest.hexdigest()}"
+
+def send_batch(qs, questions, fudge_points, key):
+    quiz.send_quiz_grades(qs, questions, fudge_points)
+    with journal_lock:
+        journal.write(key + '\n')
+        journal.flush()
+
 parser = argparse.ArgumentParser()
 canvas.Canvas.add_arguments(parser, quiz=True)
 parser.add_argument("grades", type=str,
                     help="CSV file containing grades")
+parser.add_argument("--plan", action='store_true',
+                    help="Only print the grades that would be changed, without sending them")
+parser.add_argument("--all", action='store_true',
+                    help="Send all grades and comments, even if the grades have not changed")
+parser.add_argument("--journal", type=str,
+                    help="File used to record the grades already sent, so that an interrupted "
+                    "run can be resumed (default: the grades file name with '.journal')")
 args = parser.parse_args()
+if not args.journal:
+    args.journal = args.grades + '.journal'
 
 canvas = canvas.Canvas(args=args)
 
 grades = []
-student_sub = {}
+user_quiz_sub = {}
+# (quiz submission ID, attempt) -> [quiz submission, questions, fudge points, student]
+batches = {}
 
 print('Loading grades...')
 
@@ -27,6 +58,7 @@ with open(args.grades, newline='') as csvfile:
     if not all(x in reader.fieldnames for x in \
                ['Question', 'Student', 'Attempt', 'Grade', 'Comments']):
         raise ValueError('Classlist CSV file must contain at least the following columns: Question,Student,Attempt,Grade,Comments')
+    has_fudge = 'Fudge' in reader.fieldnames
     for row in reader:
         grades.append(row)
 
@@ -38,32 +70,113 @@ print('Using course: %s / %s' % (course['term']['name'],
 quiz = course.quiz(args.quiz, prompt_if_needed=True)
 print('Using quiz: %s' % (quiz['title']))
 
-print('Retrieving quiz submissions...')
-(quiz_submissions, submissions) = quiz.submissions(include_history=False)
+print('Retrieving students...')
+roster = course.roster(max_age=args.roster_max_age)
+
+print('Retrieving quiz submissions and current grades...')
+(quiz_submissions, submissions) = quiz.submissions(include_user=False, include_submission=True,
+                                                   include_history=True)
 
-for submission in submissions.values():
-    submission['quiz_submissions'] = []
-    snum = submission['user']['sis_user_id']
-    if snum not in student_sub:
-        student_sub[snum] = []
-    student_sub[snum].append(submission)
 for qs in quiz_submissions:
-    sub = submissions[qs['submission_id']]
-    sub['quiz_submissions'].append(qs)
+    if qs['user_id'] not in user_quiz_sub:
+        user_quiz_sub[qs['user_id']] = []
+    user_quiz_sub[qs['user_id']].append(qs)
 
-print('\nSending grades...')
+# Current score of each question, by (quiz submission ID, attempt)
+current_scores = {}
+for qs in quiz_submissions:
+    sub = submissions.get(qs['submission_id'])
+    for attempt in sub['submission_history'] if sub else []:
+        current_scores[(qs['id'], attempt['attempt'])] = {
+            answer['question_id']: answer.get('points')
+            for answer in attempt.get('submission_data', [])}
 
-num_exams = 0
-for grade in grades:
-    print("Updating grade %d out of %d..." %
-          (num_exams + 1, len(grades)), end='\r')
+# The saved roster may predate recent enrollments
+if args.roster_max_age and any(roster.find(grade['Student']) is None for grade in grades):
+    roster = course.roster()
 
-    for sub in student_sub[grade['Student']]:
-        for qs in sub['quiz_submissions']:
-            if str(qs['attempt']) == grade['Attempt']:
-                quiz.send_quiz_grade(qs, int(grade['Question']),
-                                     grade['Grade'], grade['Comments'])
+# All the grades of an attempt are sent in a single request
+for grade in grades:
+    student = roster.find(grade['Student'])
+    if student is None:
+        print('Ignoring student %s, not on Canvas.' % grade['Student'])
+        continue
+    for qs in user_quiz_sub.get(student['id'], []):
+        if str(qs['attempt']) == grade['Attempt']:
+            batch = batches.setdefault((qs['id'], qs['attempt']), [qs, {}, None, grade['Student']])
+            batch[1][int(grade['Question'])] = {'score': grade['Grade'],
+                                                'comment': grade['Comments']}
+            if has_fudge and grade['Fudge']:
+                batch[2] = grade['Fudge']
+
+# Unless --all is used, only the grades that differ from those on Canvas
+# are sent. Comments cannot be compared, so the comments of unchanged
+# grades are not sent either.
+changes = []
+unsent_comments = []
+for ((qs_id, attempt), (qs, questions, fudge_points, student)) in batches.items():
+    scores = current_scores.get((qs_id, attempt), {})
+    if args.all:
+        changed = questions
+    else:
+        changed = {question_id: grade for (question_id, grade) in questions.items()
+                   if not same_score(scores.get(question_id), grade['score'])}
+        unsent_comments += [(student, qs['attempt'], question_id)
+                            for (question_id, grade) in questions.items()
+                            if question_id not in changed and grade['comment']]
+        if fudge_points is not None and same_score(qs.get('fudge_points'), fudge_points):
+            fudge_points = None
+    if changed or fudge_points is not None:
+        changes.append((qs, changed, fudge_points, student, scores))
+
+print('%d of %d submissions have changed grades.' % (len(changes), len(batches)))
+if unsent_comments:
+    print('WARNING: %d comments are not sent, as their grades have not changed '
+          '(use --all to send them).' % len(unsent_comments))
+
+if args.plan:
+    for (qs, questions, fudge_points, student, scores) in changes:
+        for (question_id, grade) in questions.items():
+            print('Student %s, attempt %d, question %d: %s -> %s' %
+                  (student, qs['attempt'], question_id, scores.get(question_id), grade['score']))
+        if fudge_points is not None:
+            print('Student %s, attempt %d, fudge points: %s -> %s' %
+                  (student, qs['attempt'], qs.get('fudge_points'), fudge_points))
+    for (student, attempt, question_id) in unsent_comments:
+        print('Student %s, attempt %d, question %d: grade unchanged, comment not sent' %
+              (student, attempt, question_id))
+    sys.exit(0)
+
+# Grades recorded in the journal were sent by a previous (interrupted) run
+done = set()
+if os.path.exists(args.journal):
+    with open(args.journal) as file:
+        done = set(line.strip() for line in file)
+    print('Resuming from %s.' % args.journal)
+pending = [(qs, questions, fudge_points, batch_key(qs, questions, fudge_points))
+           for (qs, questions, fudge_points, _, _) in changes]
+pending = [item for item in pending if item[3] not in done]
 
-    num_exams += 1
+print('\nSending grades...')
 
+journal_lock = threading.Lock()
+failed = 0
+num_exams = 0
+with open(args.journal, 'a') as journal, \
+        ThreadPoolExecutor(max_workers=canvas.session.pool_size) as executor:
+    futures = [executor.submit(send_batch, *item) for item in pending]
+    for future in as_completed(futures):
+        num_exams += 1
+        print("Updated submission %d out of %d..." %
+              (num_exams, len(pending)), end='\r')
+        try:
+            future.result()
+        except Exception as exc:  # pylint: disable=broad-except
+            failed += 1
+            print('\nERROR: %s' % exc)
+
+if failed:
+    print('\n%d submissions could not be updated, run again to retry them.' % failed)
+    sys.exit(1)
+os.remove(args.journal)
 print('\nDONE.')
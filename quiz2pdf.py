@@ -7,10 +7,13 @@ from os import path
 import json
 import zipfile
 import argparse
-import requests
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import weasyprint
 
 import canvas
+from canvas import remove_zip_duplicates
 
 def start_file(file_name):
     if path.exists(file_name):
@@ -33,22 +36,158 @@ def save_raw_answer(answer, identification):
         answer['text'] = '<div class="file-upload">See file(s): <ul>'
         for cfile in [canvas.file(a) for a in answer['attachment_ids']]:
             raw_file_name = f"answer_{identification}_{cfile['display_name']}"
-            result = requests.get(cfile['url'])
+            result = canvas.session.get(cfile['url'])
             if result:
                 rawanswers_file.writestr(raw_file_name, result.content)
                 answer['text'] += f'<li>{raw_file_name}</li>'
         answer['text'] += '</ul></div>'
 
 
-def write_exam_file(htmlfile, question_dict, quiz_submission=None):
+NO_SUBMISSION_TEXT = '''
+            *** NO SUBMISSION ***<br/><br/>
+            This typically means that this question is part of a question
+            group, and the student did not receive this question in the
+            group (i.e., the student answered a different question in
+            this set).
+            '''
+
+class QuestionRenderer:
+    """ Renders the HTML of a question with the answer of any student. The
+    parts that only depend on the question (lookup tables of choices,
+    blanks and matches, and static HTML) are built once. """
+
+    def __init__(self, question_id, question):
+        self.question_id = question_id
+        self.question_type = question['question_type']
+        self.question_text = question['question_text']
+        if self.question_type == 'text_only_question':
+            return
+        self.header = f'''<div class="question-preamble question-{question_id}"></div>
+        <div class="question-container question-{question_id}">
+        <h2 class="question-title">Question {question_id} [{question['question_name']}]:</h2>
+        <div class=question>'''
+        self.points_html = f'''</div>
+        <div class=points-container>
+          <span class=points-possible><span>{question['points_possible']}&nbsp;</span></span>
+          <span class=points-canvas><span>'''
+        self.answer_title_html = '''&nbsp;</span></span>
+        </div>
+        <h3 class=answer-title>Answer'''
+        self.answer_html = ''':</h3>
+        <div class=answer>'''
+        self.footer = '''</div>
+        </div>
+        '''
+
+        if self.question_type in ('calculated_question',
+                                  'short_answer_question',
+                                  'essay_question',
+                                  'numerical_question',
+                                  'file_upload_question'):
+            self.format_answer = None
+        elif self.question_type in ('true_false_question',
+                                    'multiple_choice_question',
+                                    'multiple_answers_question'):
+            # (answer ID, answer key, HTML after the choice mark)
+            self.choices = [(pan['id'], f"answer_{pan['id']}",
+                             '&nbsp;</span></span>&nbsp;&nbsp;'
+                             f'<span class="mc-item-text">{pan["text"]}</span></div>')
+                            for pan in question['answers']]
+            self.format_answer = self.format_choices
+        elif self.question_type in ('fill_in_multiple_blanks_question',
+                                    'multiple_dropdowns_question'):
+            tokens = []
+            self.dd_answers = {}
+            for pan in question['answers']:
+                if pan['blank_id'] not in tokens:
+                    tokens.append(pan['blank_id'])
+                self.dd_answers[pan['id']] = pan['text']
+            self.blanks = [(f'answer_for_{token}',
+                            f'<tr><td class="multiple-blanks-token">{token}</td>'
+                            '<td>=></td><td class=multiple-blanks-answer>')
+                           for token in tokens]
+            self.format_answer = self.format_blanks
+        elif self.question_type == 'matching_question':
+            self.matches = {f"{match['match_id']}": match['text']
+                            for match in question['matches']}
+            self.pairs = [(f"answer_{pan['id']}",
+                           f'<tr><td class="multiple-blanks-token">{pan["text"]}</td>'
+                           '<td>=></td><td class="multiple-blanks-answer">')
+                          for pan in question['answers']]
+            self.format_answer = self.format_matches
+        else:
+            raise ValueError(f'Invalid question type: "{self.question_type}"')
+
+    def format_choices(self, answer):
+        parts = []
+        for (answer_id, key, html) in self.choices:
+            if self.question_type == 'multiple_answers_question':
+                choice = answer[key] if answer is not None and key in answer else ''
+                if choice == '0':
+                    choice = ''
+            else:
+                choice = 'X' if answer is not None and 'answer_id' in answer and \
+                    answer_id == answer['answer_id'] else ''
+            parts += ['<div class="mc-item"><span class="mc-item-space"><span>&nbsp;',
+                      str(choice), html]
+        return ''.join(parts)
+
+    def format_blanks(self, answer):
+        parts = ['<table class="multiple-blanks-table">']
+        for (key, html) in self.blanks:
+            choice = answer[key] if answer is not None and key in answer else ''
+            if choice != '' and self.question_type == 'multiple_dropdowns_question' and \
+                    choice in self.dd_answers:
+                choice = self.dd_answers[choice]
+            parts += [html, str(choice), '</td></tr>']
+        parts.append('</table>')
+        return ''.join(parts)
+
+    def format_matches(self, answer):
+        parts = ['<table class="multiple-blanks-table">']
+        for (key, html) in self.pairs:
+            choice = self.matches[answer[key]] if answer is not None and key in answer \
+                and answer[key] in self.matches else ''
+            parts += [html, choice, '</td></tr>']
+        parts.append('</table>')
+        return ''.join(parts)
+
+    def render(self, answers, num_attempts, sub_questions, submitted):
+        """ Returns the HTML of the question, given the answers of a
+        student (by question ID), if submitted, or empty otherwise (for the
+        template) """
+        question_text = self.question_text
+        if self.question_type == 'text_only_question':
+            return f"<div class='text-only-question'>{question_text}</div>"
+        if self.question_id in sub_questions and self.question_type == 'calculated_question':
+            question_text = sub_questions[self.question_id]['question_text']
+
+        answer = answers.get(self.question_id)
+        points = ''
+        if answer is not None:
+            answer_text = answer['text'] if 'text' in answer else ''
+            points = answer['points']
+            if self.format_answer:
+                answer_text = self.format_answer(answer)
+        elif submitted:
+            answer_text = NO_SUBMISSION_TEXT
+        else:
+            answer_text = self.format_answer(None) if self.format_answer else ''
+
+        num_attempts_text = '' if num_attempts <= 1 else f' ({num_attempts} attempts)'
+        return ''.join([self.header, question_text, self.points_html, str(points),
+                        self.answer_title_html, num_attempts_text, self.answer_html,
+                        answer_text, self.footer])
+
+
+def write_exam_file(htmlfile, renderers, quiz_submission=None, sub=None, sub_questions=None):
     acct = ''
     snum = ''
     sname = ''
     answers = {}
-    sub_questions = {}
+    sub_questions = sub_questions or {}
     num_attempts = 0
     if quiz_submission is not None:
-        sub = submissions[quiz_submission['submission_id']]
         snum = sub['user']['sis_user_id']
         sname = sub['user']['name']
         if args.classlist:
@@ -59,8 +198,6 @@ def write_exam_file(htmlfile, question_dict, quiz_submission=None):
         else:
             acct = snum
 
-        sub_questions = quiz.submission_questions(quiz_submission)
-
         previous_score = -1
         previous_attempt = -1
         variation = {}
@@ -105,118 +242,29 @@ def write_exam_file(htmlfile, question_dict, quiz_submission=None):
         <span><span class='sname'>{sname}</span></span>
         </div>''')
 
-    qnum = 1
-    for (question_id, question) in question_dict.items():
-        question_name = question['question_name']
-        question_text = question['question_text']
-        question_type = question['question_type']
-        if question_id in sub_questions and question_type == 'calculated_question':
-            question_text = sub_questions[question_id]['question_text']
-        if question_type == 'text_only_question':
-            htmlfile.write(f"<div class='text-only-question'>{question_text}</div>")
-            continue
-
-        worth = question['points_possible']
-        answer = None
-        answer_text = ''
-        points = ''
-
-        if question_id in answers:
-            answer = answers[question_id]
-            answer_text = answer['text'] if 'text' in answer else ''
-            points = answer['points']
-        elif quiz_submission is not None:
-            question_type = None # To avoid formatting of multiple-choice
-            answer_text = '''
-            *** NO SUBMISSION ***<br/><br/>
-            This typically means that this question is part of a question
-            group, and the student did not receive this question in the
-            group (i.e., the student answered a different question in
-            this set).
-            '''
-
-        if question_type in ('calculated_question',
-                             'short_answer_question',
-                             'essay_question',
-                             'numerical_question'):
-            pass # use answer exactly as provided
-        elif question_type in ('true_false_question',
-                               'multiple_choice_question',
-                               'multiple_answers_question'):
-            answer_text = ''
-            for pan in question['answers']:
-                if question_type == 'multiple_answers_question':
-                    key = f"answer_{pan['id']}"
-                    choice = answer[key] if answer is not None and key in answer else ''
-                    if choice == '0':
-                        choice = ''
-                else:
-                    choice = 'X' if answer is not None and 'answer_id' in answer and pan['id'] == answer['answer_id'] else ''
-                answer_text += '<div class="mc-item">'
-                answer_text += f'<span class="mc-item-space"><span>&nbsp;{choice}&nbsp;</span></span>'
-                answer_text += '&nbsp;&nbsp;'
-                answer_text += f'<span class="mc-item-text">{pan["text"]}</span>'
-                answer_text += '</div>'
-
-        elif question_type in ('fill_in_multiple_blanks_question',
-                               'multiple_dropdowns_question'):
-            answer_text = '<table class="multiple-blanks-table">'
-            tokens = []
-            dd_answers = {}
-            for pan in question['answers']:
-                if pan['blank_id'] not in tokens:
-                    tokens.append(pan['blank_id'])
-                dd_answers[pan['id']] = pan['text']
-            for token in tokens:
-                key = f'answer_for_{token}'
-                choice = answer[key] if answer is not None and key in answer else ''
-                if choice != '' and question_type == 'multiple_dropdowns_question' and choice in dd_answers:
-                    choice = dd_answers[choice]
-                answer_text += '<tr>'
-                answer_text += f'<td class="multiple-blanks-token">{token}</td>'
-                answer_text += '<td>=></td>'
-                answer_text += f'<td class=multiple-blanks-answer>{choice}</td>'
-                answer_text += '</tr>'
-            answer_text += '</table>'
-
-        elif question_type == 'matching_question':
-            answer_text = '<table class="multiple-blanks-table">'
-            matches = {}
-            for match in question['matches']:
-                matches[f"{match['match_id']}"] = match['text']
-            for pan in question['answers']:
-                key = f"answer_{pan['id']}"
-                choice = matches[answer[key]] if answer is not None and key in answer and answer[key] in matches else ''
-                answer_text += '<tr>'
-                answer_text += f'<td class="multiple-blanks-token">{pan["text"]}</td>'
-                answer_text += '<td>=></td>'
-                answer_text += f'<td class="multiple-blanks-answer">{choice}</td>'
-                answer_text += '</tr>'
-            answer_text += '</table>'
-
-        elif question_type == 'file_upload_question':
-            pass # This is handled in the processing of history above.
-        elif question_type is not None:
-            raise ValueError(f'Invalid question type: "{question_type}"')
-
-        num_attempts_text = '' if num_attempts <= 1 else f' ({num_attempts} attempts)'
-        htmlfile.write(f'''<div class="question-preamble question-{question_id}"></div>
-        <div class="question-container question-{question_id}">
-        <h2 class="question-title">Question {question_id} [{question_name}]:</h2>
-        <div class=question>{question_text}</div>
-        <div class=points-container>
-          <span class=points-possible><span>{worth}&nbsp;</span></span>
-          <span class=points-canvas><span>{points}&nbsp;</span></span>
-        </div>
-        <h3 class=answer-title>Answer{num_attempts_text}:</h3>
-        <div class=answer>{answer_text}</div>
-        </div>
-        ''')
-        qnum += 1
+    htmlfile.write(''.join(renderer.render(answers, num_attempts, sub_questions,
+                                           quiz_submission is not None)
+                           for renderer in renderers))
 
 def end_file(htmlfile):
     htmlfile.write('</body>\n</html>')
     htmlfile.close()
+    # Convert in the background while the following files are written
+    job = pdf_executor.submit(write_pdf, htmlfile.name)
+    job.add_done_callback(lambda job: report_pdf(job, htmlfile.name))
+    pdf_jobs[job] = htmlfile.name
+
+def report_pdf(job, file_name):
+    if not job.cancelled() and job.exception() is None:
+        print(f'\n{file_name}.pdf done.')
+
+# Runs in each PDF worker, so that stylesheets are parsed once per worker
+def init_pdf_worker(css_files):
+    global css
+    css = [weasyprint.CSS(css_file) for css_file in css_files]
+
+def write_pdf(file_name):
+    weasyprint.HTML(filename=file_name).write_pdf(f'{file_name}.pdf', stylesheets=css)
 
 def question_included(qid):
     if args.not_question and qid in args.not_question:
@@ -238,16 +286,44 @@ group.add_argument("--only-question", action='extend', nargs='+', type=int, meta
                    help="Questions to include")
 group.add_argument("--not-question", action='extend', nargs='+', type=int, metavar="QUESTIONID",
                    help="Questions to exclude")
+parser.add_argument("-j", "--jobs", type=int, default=1,
+                    help="Number of PDF files converted at the same time (e.g., the number of cores).")
+parser.add_argument("--chunk-size", type=int, default=1000, metavar="KB",
+                    help="""Approximate size of the HTML of each exams file.
+                    Students are added to a file until this size is reached.""")
+parser.add_argument("--per-student", action='store_true',
+                    help="Create one exams file per student.")
 parser.add_argument("--css",
                     help="Additional CSS file to use in PDF creation.")
 parser.add_argument("--template-only", action='store_true',
                     help="Create only the template, without students.")
+parser.add_argument("--incremental", action='store_true',
+                    help="""Only export the students whose submissions changed
+                    since the previous incremental run (requires --cache),
+                    into new exam files.""")
 args = parser.parse_args()
+if args.incremental and not args.cache:
+    parser.error('--incremental requires --cache')
 
 canvas = canvas.Canvas(args=args)
 
 student_accounts = {}
 htmlfile_list = []
+pdf_jobs = {}
+
+css_files = [path.join(path.dirname(__file__), 'canvasquiz.css')]
+if args.css:
+    css_files.append(args.css)
+# PDF conversion is CPU-bound, so it runs in worker processes. These are
+# forked (not spawned) as the script has no main guard; where fork is not
+# available, threads are used instead.
+if 'fork' in multiprocessing.get_all_start_methods():
+    pdf_executor = ProcessPoolExecutor(max_workers=args.jobs,
+                                       mp_context=multiprocessing.get_context('fork'),
+                                       initializer=init_pdf_worker, initargs=(css_files,))
+else:
+    pdf_executor = ThreadPoolExecutor(max_workers=args.jobs,
+                                      initializer=init_pdf_worker, initargs=(css_files,))
 
 if args.classlist:
     print('Reading classlist...')
@@ -276,55 +352,91 @@ if not args.output_prefix:
 print('Retrieving quiz questions...')
 (questions, groups) = quiz.questions(question_included)
 
-print('Retrieving quiz submissions...')
-if args.template_only:
-    quiz_submissions = []
-    submissions = {}
-else:
-    (quiz_submissions, submissions) = quiz.submissions()
-
 print('Generating HTML files...')
 
 file_no = 1
 template_file = start_file(f'{args.output_prefix}_template.html')
-if not args.template_only:
-    exams_file = start_file(f'{args.output_prefix}_exams_{file_no}.html')
-    rawanswers_file = zipfile.ZipFile(f'{args.output_prefix}_raw_answers.zip', 'w')
-
-write_exam_file(template_file, questions)
+# Question-level HTML and lookup tables are built once for all students
+renderers = [QuestionRenderer(question_id, question)
+             for (question_id, question) in questions.items()]
+write_exam_file(template_file, renderers)
+end_file(template_file)
 
 if args.debug:
-    with open('debug.json', 'w') as file:
-        data = {}
-        data['quiz'] = quiz.data
-        data['questions'] = questions
-        data['quiz_submissions'] = quiz_submissions
-        data['submissions'] = submissions
-        json.dump(data, file, indent=2)
-
-num_exams = 0
-for qs in quiz_submissions:
-    print(f"Exporting student {num_exams + 1} out of {len(quiz_submissions)}...", end='\r')
-    write_exam_file(exams_file, questions, qs)
-    num_exams += 1
-    if num_exams % 20 == 0:
-        end_file(exams_file)
-        file_no += 1
-        exams_file = start_file(f'{args.output_prefix}_exams_{file_no}.html')
+    debug_data = {}
+    debug_data['quiz'] = quiz.data
+    debug_data['questions'] = questions
+    debug_data['quiz_submissions'] = []
+    debug_data['submissions'] = {}
 
-end_file(template_file)
 if not args.template_only:
+    print('Retrieving quiz submissions...')
+    if args.incremental:
+        (quiz_submissions, submissions, sync) = quiz.changed_submissions(
+            f'quiz2pdf:{path.abspath(args.output_prefix)}')
+        print(f'{len(quiz_submissions)} new or changed submissions.')
+        updated = set(sync['updated'])
+        submission_stream = ((qs, submissions.get(qs['submission_id']))
+                             for qs in quiz_submissions)
+        # Keep the exam files of previous runs
+        while path.exists(f'{args.output_prefix}_exams_{file_no}.html'):
+            file_no += 1
+    else:
+        submission_stream = quiz.iterate_submissions()
+    exams_file = start_file(f'{args.output_prefix}_exams_{file_no}.html')
+    rawanswers_file = zipfile.ZipFile(f'{args.output_prefix}_raw_answers.zip',
+                                      'a' if args.incremental else 'w')
+    if args.incremental:
+        # The answers of re-exported submissions replace the previous ones
+        # once the file is complete
+        warnings.filterwarnings('ignore', 'Duplicate name', UserWarning)
+
+    # Students are rendered as their submissions arrive, and each exams
+    # file is converted to PDF as soon as it is complete. Files are split
+    # by size (which drives the memory and time needed to convert them),
+    # rather than by number of students.
+    num_exams = 0
+    file_exams = 0
+    for ((qs, sub), sub_questions) in quiz.prefetch_submission_questions(submission_stream):
+        if sub is None:
+            print(f"\nSubmission not found for quiz submission {qs['id']}")
+            continue
+        if file_exams and (args.per_student or exams_file.tell() >= args.chunk_size * 1024):
+            end_file(exams_file)
+            file_no += 1
+            file_exams = 0
+            exams_file = start_file(f'{args.output_prefix}_exams_{file_no}.html')
+        if args.incremental and sub['id'] in updated:
+            # Earlier exam files are not rewritten, so they still contain
+            # the previous version of this submission
+            print(f"\nWARNING: Submission of student {sub['user']['sis_user_id']} changed "
+                  "since it was exported by a previous run. Its previous version is "
+                  "still in an earlier exams file.")
+        print(f"Exporting student {num_exams + 1}...", end='\r')
+        write_exam_file(exams_file, renderers, qs, sub, sub_questions)
+        num_exams += 1
+        file_exams += 1
+        if args.debug:
+            debug_data['quiz_submissions'].append(qs)
+            debug_data['submissions'][sub['id']] = sub
+
     end_file(exams_file)
     rawanswers_file.close()
+    if args.incremental:
+        remove_zip_duplicates(rawanswers_file.filename)
 
-print('\nConverting to PDF...')
-css = [weasyprint.CSS(path.join(path.dirname(__file__), 'canvasquiz.css'))]
-if args.css:
-    css.append(weasyprint.CSS(args.css))
+if args.debug:
+    with open('debug.json', 'w') as file:
+        json.dump(debug_data, file, indent=2)
 
-for file in htmlfile_list:
-    print(f'{file}...  ', end='\r')
-    weasyprint.HTML(filename=file).write_pdf(f'{file}.pdf', stylesheets=css)
+print('\nWaiting for the remaining PDF files...')
+for job in pdf_jobs:
+    job.result()
+pdf_executor.shutdown()
+
+# The submissions are only marked as exported once all files are created
+if args.incremental and not args.template_only:
+    course.save_sync(sync)
 
 print('\nDONE. Created files:')
 for file in htmlfile_list:
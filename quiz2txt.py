@@ -5,15 +5,15 @@ import re
 import json
 import zipfile
 import argparse
-import requests
+import warnings
 import canvas
+from canvas import remove_zip_duplicates
 
-def process_submission(qsub):
+def process_submission(qsub, sub_questions):
     num_attempts = 0
 
     sub = submissions[qsub['submission_id']]
     snum = sub['user']['sis_user_id']
-    sub_questions = quiz.submission_questions(qsub)
 
     variation = {}
     for attempt in sub['submission_history']:
@@ -41,7 +41,8 @@ def process_submission(qsub):
 
             if question_id not in zipfiles:
                 zipfiles[question_id] = zipfile.ZipFile(
-                    f"{args.output_prefix}_{question['question_name']}_{question_id}.zip", 'w')
+                    f"{args.output_prefix}_{question['question_name']}_{question_id}.zip",
+                    'a' if args.incremental else 'w')
             zipf = zipfiles[question_id]
             common_substring = f"{question_id}_{snum}_v{attempt['attempt']}{variation[attempt['attempt']]}"
             # if question['quiz_group_id'] != None:
@@ -52,7 +53,7 @@ def process_submission(qsub):
             elif question['question_type'] == 'file_upload_question':
                 for cfile in [canvas.file(a) for a in answer['attachment_ids']]:
                     raw_file_name = f"{common_substring}_upload_{cfile['display_name']}"
-                    data = requests.get(cfile['url'])
+                    data = canvas.session.get(cfile['url'])
                     if data:
                         zipf.writestr(raw_file_name, data.content)
             rubric_file = f'{common_substring}_rubric.txt'
@@ -80,7 +81,12 @@ group.add_argument("--only-question", action='extend', nargs='+', type=int, meta
                    help="Questions to include")
 group.add_argument("--not-question", action='extend', nargs='+', type=int, metavar="QUESTIONID",
                    help="Questions to exclude")
+parser.add_argument("--incremental", action='store_true',
+                    help="Only export the students whose submissions changed since the "
+                    "previous incremental run (requires --cache), adding to the existing files")
 args = parser.parse_args()
+if args.incremental and not args.cache:
+    parser.error('--incremental requires --cache')
 
 canvas = canvas.Canvas(args=args)
 
@@ -98,7 +104,15 @@ if not args.output_prefix:
     print(f'Using prefix: {args.output_prefix}')
 
 print('Retrieving quiz submissions...')
-(quiz_submissions, submissions) = quiz.submissions()
+if args.incremental:
+    # The files of re-exported submissions replace the previous ones once
+    # the ZIP files are complete
+    warnings.filterwarnings('ignore', 'Duplicate name', UserWarning)
+    (quiz_submissions, submissions, sync) = quiz.changed_submissions(
+        f'quiz2txt:{os.path.abspath(args.output_prefix)}')
+    print(f'{len(quiz_submissions)} new or changed submissions.')
+else:
+    (quiz_submissions, submissions) = quiz.submissions()
 
 print('\nGenerating files...')
 
@@ -111,12 +125,18 @@ if args.debug:
         json.dump(ddata, file, indent=2)
 
 num_exams = 0
-for quizsub in quiz_submissions:
+for (quizsub, sub_questions) in quiz.prefetch_submission_questions(quiz_submissions):
     print(f"Exporting student {num_exams + 1} out of {len(quiz_submissions)}...", end='\r')
-    process_submission(quizsub)
+    process_submission(quizsub, sub_questions)
     num_exams += 1
 
 for zf in zipfiles.values():
     zf.close()
+    if args.incremental:
+        remove_zip_duplicates(zf.filename)
+
+# The submissions are only marked as exported once all files are created
+if args.incremental:
+    course.save_sync(sync)
 
 print('\nDONE.')